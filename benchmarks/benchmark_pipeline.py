@@ -0,0 +1,162 @@
+# benchmark_pipeline.py
+#
+# Synthetic-data benchmark of every stage of the distortion correction
+# pipeline. For each size N it generates an MR volume and a B0 map on an
+# (N/2)^3 grid, which are upsampled to the N^3 target grid as in
+# B0_correction.main, and a smooth phantom GNL displacement field, then times
+# each stage separately. Results are written as JSON; with --check the run
+# fails if a stage is slower than its threshold.
+#
+# Usage:
+#     python benchmarks/benchmark_pipeline.py --sizes 64 128 256 --output bench.json
+#     python benchmarks/benchmark_pipeline.py --sizes 64 128 --check benchmarks/thresholds.json
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+import scipy
+import SimpleITK as sitk
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from B0_correction import apply_b0_displacement, apply_b0_shift_1d, formula, register_b0_map, upsample_image
+from B0_GNL_composed_correction import fused_correction, target_grid_image
+from Phantom_displacement_GNL import apply_phantom_field, resample_phantom_field
+
+def synthetic_inputs(size, seed=0):
+    """Synthetic MR volume, B0 map (Hz) and phantom GNL field (voxels) for an N^3 target grid."""
+    rng = np.random.default_rng(seed)
+    n = size // 2
+    z, y, x = (axis / np.float32(n) for axis in np.ogrid[:n, :n, :n])
+
+    # Ellipsoidal "brain" with an inner structure, plus noise
+    body = ((z - 0.5) / 0.4) ** 2 + ((y - 0.5) / 0.35) ** 2 + ((x - 0.5) / 0.38) ** 2 < 1
+    inner = ((z - 0.45) / 0.12) ** 2 + ((y - 0.55) / 0.15) ** 2 + ((x - 0.45) / 0.1) ** 2 < 1
+    mr = (800 * body + 400 * inner).astype(np.float32)
+    mr += rng.normal(0, 20, mr.shape).astype(np.float32)
+
+    # Smooth B0 inhomogeneity of a few hundred Hz inside the body
+    b0 = (300 * np.sin(3 * z) * np.cos(2 * y) + 150 * x).astype(np.float32) * body
+
+    # Smooth GNL displacement growing towards the edges of the FOV
+    m = max(2, int(size * 0.8))
+    gz, gy, gx = (axis / np.float32(m) - np.float32(0.5) for axis in np.ogrid[:m, :m, :m])
+    radius = gz ** 2 + gy ** 2 + gx ** 2
+    gnl = np.stack(np.broadcast_arrays(2 * gz * radius, 2 * gy * radius, 4 * gx * radius), axis=-1)
+
+    spacing = (0.2, 0.2, 0.25)
+    MR_Volume = sitk.GetImageFromArray(mr)
+    MR_Volume.SetSpacing(spacing)
+    B0_Map = sitk.GetImageFromArray(b0 + 0.3 * mr)
+    B0_Map.SetSpacing(spacing)
+    return MR_Volume, B0_Map, np.ascontiguousarray(gnl, dtype=np.float32)
+
+def _time(stage_times, name, function, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    stage_times[name] = best
+    return result
+
+def benchmark_size(size, repeats=1):
+    """Times every pipeline stage for one target size and returns {stage: seconds}."""
+    MR_Volume, B0_Map, gnl = synthetic_inputs(size)
+    target_shape = (size, size, size)
+    stage_times = {}
+
+    _, B0_Map_Resampled = _time(stage_times, 'registration',
+                                lambda: register_b0_map(MR_Volume, B0_Map), repeats)
+    B0_Map_Resampled_Array = sitk.GetArrayFromImage(B0_Map_Resampled)
+    MR_Volume_Array = sitk.GetArrayFromImage(MR_Volume)
+
+    B0_Map_Upsampled_Array, _ = _time(stage_times, 'zoom_upsampling_b0',
+                                      lambda: upsample_image(B0_Map, B0_Map_Resampled_Array, target_shape),
+                                      repeats)
+    MR_Volume_Upsampled_Array, MR_Volume_Upsampled = _time(
+        stage_times, 'zoom_upsampling_mr',
+        lambda: upsample_image(MR_Volume, MR_Volume_Array, target_shape), repeats
+    )
+
+    B0_Map_Array_mm = _time(stage_times, 'field_construction',
+                            lambda: formula(B0_Map_Upsampled_Array), repeats)
+    spacing = MR_Volume_Upsampled.GetSpacing()[2]
+    B0_Corrected_Array = _time(
+        stage_times, 'b0_resample_1d',
+        lambda: apply_b0_shift_1d(MR_Volume_Upsampled_Array, B0_Map_Array_mm, spacing), repeats
+    )
+    _time(stage_times, 'b0_resample_sitk',
+          lambda: apply_b0_displacement(MR_Volume_Upsampled, B0_Map_Array_mm), repeats)
+
+    gnl_resampled = _time(stage_times, 'gnl_field_resampling',
+                          lambda: resample_phantom_field(gnl, target_shape), repeats)
+    corrected = _time(stage_times, 'gnl_map_coordinates',
+                      lambda: apply_phantom_field(B0_Corrected_Array, gnl_resampled), repeats)
+
+    target_image = target_grid_image(MR_Volume, target_shape)
+    B0_Map_mm_mr_grid = formula(B0_Map_Resampled_Array.astype(np.float32))
+    _time(stage_times, 'fused_warp',
+          lambda: fused_correction(MR_Volume_Array, B0_Map_mm_mr_grid, gnl_resampled, target_image),
+          repeats)
+
+    corrected_volume = sitk.GetImageFromArray(corrected)
+    with tempfile.TemporaryDirectory() as tmp:
+        output_path = os.path.join(tmp, 'corrected.nii')
+        _time(stage_times, 'nifti_write', lambda: sitk.WriteImage(corrected_volume, output_path), repeats)
+    return stage_times
+
+def check_thresholds(results, thresholds):
+    """Returns a list of 'size/stage' entries slower than their threshold (seconds)."""
+    regressions = []
+    for size, stages in results['sizes'].items():
+        for stage, limit in thresholds.get(size, {}).items():
+            if stage in stages and stages[stage] > limit:
+                regressions.append(f"{size}/{stage}: {stages[stage]:.3f} s > {limit:.3f} s")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the distortion correction stages on synthetic data.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 128],
+                        help="Target grid sizes N (N^3 voxels), e.g. 64 128 256 512")
+    parser.add_argument('--repeats', type=int, default=1, help="Repetitions per stage; the best time is kept")
+    parser.add_argument('--output', default='bench_output.json', help="JSON result file")
+    parser.add_argument('--check', metavar='THRESHOLDS', help="JSON file of per-size stage thresholds (s)")
+    args = parser.parse_args()
+
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'SimpleITK': sitk.Version_VersionString(),
+            'cpu_count': os.cpu_count(),
+            'machine': platform.machine(),
+        },
+        'sizes': {},
+    }
+    for size in args.sizes:
+        results['sizes'][str(size)] = benchmark_size(size, args.repeats)
+        for stage, seconds in results['sizes'][str(size)].items():
+            print(f"{size:4d}^3  {stage:<22s} {seconds:8.3f} s")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.check:
+        with open(args.check) as f:
+            regressions = check_thresholds(results, json.load(f))
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+# b0_gnl_composed_correction.py
+#
+# Single-pass variant of the two-step distortion correction: the z-only B0
+# displacement and the phantom GNL displacement are composed into one
+# coordinate map, so the MR volume is interpolated only once and no
+# intermediate B0-corrected NIfTI is written. The fused variant also folds the
+# upsampling to the target grid into that single interpolation pass.
+
+import os
+
+import numpy as np
+import SimpleITK as sitk
+from scipy.ndimage import map_coordinates
+
+from B0_correction import formula, register_b0_map
+from dtype_policy import DEFAULT_DTYPE
+from gnl_field_cache import resample_phantom_field_cached
+from instrumentation import NULL_PROFILER, profiler_for
+from parallel_warp import parallel_map_coordinates, parallel_spline_filter, set_number_of_threads
+from roi_mask import bounding_box, roi_mask_image, target_mask
+
+def b0_index_displacement(B0_Map_Array_mm, image):
+    """Converts a z-direction B0 shift in mm into displacements along the array axes of image."""
+    direction = np.array(image.GetDirection()).reshape(3, 3)
+    index_to_physical = direction @ np.diag(image.GetSpacing())
+    # Continuous index step (x, y, z) produced by a 1 mm shift along physical z
+    step = np.linalg.solve(index_to_physical, [0.0, 0.0, 1.0])
+    # Array axes are ordered (z, y, x)
+    return [B0_Map_Array_mm * B0_Map_Array_mm.dtype.type(s) if s != 0 else None for s in step[::-1]]
+
+def compose_b0_gnl_coordinates(B0_Map_Array_mm, gnl_field_resampled, image, dtype=DEFAULT_DTYPE,
+                               rows=slice(None)):
+    """Builds the sampling coordinates of the composed B0 + GNL correction.
+
+    The two-step pipeline computes out[p] = b0_corrected[p + g(p)] with
+    b0_corrected[q] = mr[q + b(q)], so the composed map is
+    p -> p + g(p) + b(p + g(p)). rows restricts the output to a slab of the
+    first array axis.
+    """
+    axes = [np.arange(n, dtype=dtype) for n in B0_Map_Array_mm.shape]
+    axes[0] = axes[0][rows]
+    coordinates = np.array(np.meshgrid(*axes, indexing='ij'))
+    gnl = gnl_field_resampled[rows]
+    for i in range(3):
+        coordinates[i] += gnl[..., i]
+
+    # The B0 field is evaluated at the GNL-displaced positions; like the
+    # DisplacementFieldTransform it is interpolated linearly.
+    B0_at_gnl = map_coordinates(B0_Map_Array_mm, coordinates, order=1, mode='nearest')
+    for i, displacement in enumerate(b0_index_displacement(B0_at_gnl, image)):
+        if displacement is not None:
+            coordinates[i] += displacement
+    return coordinates
+
+def warp_volume(volume_array, coordinates, order=3, workers=1):
+    """Samples volume_array once at the composed coordinates."""
+    # Samples mapped outside the volume get the resampler's default value of 0
+    if workers != 1:
+        return parallel_map_coordinates(
+            volume_array, coordinates, order=order, mode='constant', cval=0.0, workers=workers
+        )
+    return map_coordinates(volume_array, coordinates, order=order, mode='constant', cval=0.0)
+
+def target_grid_image(image, target_shape):
+    """Returns an image carrying the geometry of image upsampled to target_shape."""
+    zoom_factors = [t / s for t, s in zip(target_shape, image.GetSize()[::-1])]
+    target = sitk.Image([int(n) for n in target_shape[::-1]], sitk.sitkUInt8)
+    target.SetOrigin(image.GetOrigin())
+    target.SetSpacing([sp / zf for sp, zf in zip(image.GetSpacing(), zoom_factors[::-1])])
+    target.SetDirection(image.GetDirection())
+    return target
+
+def fused_coordinates(B0_Map_Array_mm, gnl_field_resampled, target_image, rows=slice(None),
+                      dtype=DEFAULT_DTYPE):
+    """Sampling coordinates of the fused correction in index units of the original MR grid.
+
+    B0_Map_Array_mm is the registered B0 shift on the original MR grid. For
+    output rows of the target grid, the GNL-displaced position is mapped to
+    the original grid with the same scaling as scipy.ndimage.zoom, the B0
+    shift is evaluated lazily there, and the final position is mapped back to
+    the original grid, so upsampling and warp need only one interpolation.
+    rows may also be a tuple of slices, one per array axis, for a box of the
+    target grid.
+    """
+    dtype = np.dtype(dtype)
+    source_shape = B0_Map_Array_mm.shape
+    target_shape = target_image.GetSize()[::-1]
+    scale = [
+        dtype.type((n_in - 1) / (n_out - 1) if n_out > 1 else 1.0)
+        for n_in, n_out in zip(source_shape, target_shape)
+    ]
+
+    region = rows if isinstance(rows, tuple) else (rows,)
+    axes = [np.arange(n, dtype=dtype) for n in target_shape]
+    for i, extent in enumerate(region):
+        axes[i] = axes[i][extent]
+    coordinates = np.array(np.meshgrid(*axes, indexing='ij'))
+    gnl = gnl_field_resampled[region]
+    for i in range(3):
+        coordinates[i] += gnl[..., i]
+        coordinates[i] *= scale[i]
+
+    B0_at_gnl = map_coordinates(B0_Map_Array_mm, coordinates, order=1, mode='nearest')
+    for i, displacement in enumerate(b0_index_displacement(B0_at_gnl, target_image)):
+        if displacement is not None:
+            coordinates[i] += displacement * scale[i]
+    return coordinates
+
+def fused_correction(MR_Volume_Array, B0_Map_Array_mm, gnl_field_resampled, target_image,
+                     slab=16, workers=1, dtype=DEFAULT_DTYPE, output=None, mask=None):
+    """Upsamples and corrects the MR volume in one cubic interpolation pass, slab by slab.
+
+    output may be a preallocated (e.g. memory-mapped, see
+    nifti_mmap.create_nifti_memmap) array of the target shape that the slabs
+    are written into. mask (boolean, target shape, see roi_mask) restricts the
+    coordinates to the bounding box of the mask in each slab and the
+    interpolation to the voxels inside it; all other voxels get 0.
+    """
+    dtype = np.dtype(dtype)
+    # Same prefilter as scipy.ndimage.zoom / map_coordinates in 'constant' mode
+    coefficients = parallel_spline_filter(MR_Volume_Array, 3, mode='constant', workers=workers)
+
+    target_shape = target_image.GetSize()[::-1]
+    corrected = np.empty(target_shape, dtype=dtype) if output is None else output
+    for z0 in range(0, target_shape[0], slab):
+        rows = slice(z0, min(z0 + slab, target_shape[0]))
+        if mask is None:
+            coordinates = fused_coordinates(B0_Map_Array_mm, gnl_field_resampled, target_image, rows, dtype)
+            corrected[rows] = map_coordinates(
+                coefficients, coordinates, output=dtype, order=3, mode='constant', cval=0.0,
+                prefilter=False
+            )
+            continue
+
+        corrected[rows] = 0
+        box = bounding_box(mask[rows])
+        if box is None:
+            continue
+        region = (slice(z0 + box[0].start, z0 + box[0].stop),) + box[1:]
+        inside = mask[region]
+        coordinates = fused_coordinates(B0_Map_Array_mm, gnl_field_resampled, target_image, region, dtype)
+        values = corrected[region]
+        values[inside] = map_coordinates(
+            coefficients, coordinates[:, inside], output=dtype, order=3, mode='constant', cval=0.0,
+            prefilter=False
+        )
+    return corrected
+
+def correct_subject(MR_Volume, B0_Map, gnl_field_resampled, target_shape, workers=1,
+                    dtype=DEFAULT_DTYPE, profiler=NULL_PROFILER, roi=None, report=None):
+    """Runs registration and the fused upsampling + single-pass warp for one subject.
+
+    roi ('auto', a bounding box or a mask, see roi_mask) restricts the warp
+    to a region of interest. The registration always uses the whole image, so
+    inside the region the result is that of the full correction. If report
+    is a dict it receives the B0 shift (mm) on the MR grid under
+    'B0_Map_Array_mm'.
+    """
+    dtype = np.dtype(dtype)
+    mask_image = roi_mask_image(MR_Volume, roi)
+    with profiler.stage('registration'):
+        final_transform, B0_Map_Resampled = register_b0_map(MR_Volume, B0_Map)
+
+    with profiler.stage('field_construction'):
+        B0_Map_Array_mm = formula(sitk.GetArrayFromImage(B0_Map_Resampled).astype(dtype, copy=False))
+    if report is not None:
+        report['B0_Map_Array_mm'] = B0_Map_Array_mm
+    return correct_with_b0_shift(
+        MR_Volume, B0_Map_Array_mm, gnl_field_resampled, target_shape, workers, dtype, profiler,
+        roi=mask_image
+    )
+
+def correct_with_b0_shift(MR_Volume, B0_Map_Array_mm, gnl_field_resampled, target_shape,
+                          workers=1, dtype=DEFAULT_DTYPE, profiler=NULL_PROFILER, roi=None):
+    """Fused upsampling + single-pass warp with a B0 shift (mm) already on the MR grid.
+
+    roi restricts the warp to a region of interest (see roi_mask); the
+    output geometry is the same.
+    """
+    dtype = np.dtype(dtype)
+    target_image = target_grid_image(MR_Volume, target_shape)
+    mask = None
+    if roi is not None:
+        mask = target_mask(roi_mask_image(MR_Volume, roi), target_shape)
+    with profiler.stage('fused_warp'):
+        corrected_volume_array = fused_correction(
+            sitk.GetArrayViewFromImage(MR_Volume), B0_Map_Array_mm, gnl_field_resampled, target_image,
+            workers=workers, dtype=dtype, mask=mask
+        )
+
+    corrected_volume = sitk.GetImageFromArray(corrected_volume_array)
+    corrected_volume.CopyInformation(target_image)
+    return corrected_volume
+
+def main():
+    workers = os.cpu_count()
+    set_number_of_threads(workers)
+
+    # Per-stage timings and memory, written when DISTORTION_CORRECTION_PROFILE is set
+    profiler = profiler_for('mouse_35')
+
+    # 1. Load the MR volume and B0 map
+    with profiler.stage('load'):
+        MR_Volume = sitk.ReadImage('b0_correction_analysis/Analysis_08_10_2024/mouse/mouse_35_MR.nii')
+        B0_Map = sitk.ReadImage('b0_correction_analysis/Analysis_08_10_2024/mouse/B0_Map_Mouse.nii')
+
+    # 2. Resample the GNL field to the target grid (cached on disk per geometry)
+    target_shape = (112, 128, 128)  # Adjust if needed
+    with profiler.stage('gnl_field_resampling'):
+        Phantom_Displacement_Field_Array_Resampled = resample_phantom_field_cached(
+            'b0_correction_analysis/Analysis_08_10_2024/mouse/Cropped_Displacement_Field_Mouse_Dimensions.nii',
+            MR_Volume, target_shape
+        )
+
+    # 3. Register, compose both displacements and interpolate the MR volume once
+    corrected_volume = correct_subject(
+        MR_Volume, B0_Map, Phantom_Displacement_Field_Array_Resampled, target_shape, workers,
+        profiler=profiler
+    )
+
+    # 4. Save the B0+GNL corrected volume
+    with profiler.stage('write'):
+        sitk.WriteImage(
+            corrected_volume,
+            'b0_correction_analysis/Analysis_08_10_2024/mouse/Mouse_B0_GNL_Corrected_Single_Pass_MR_resolution.nii'
+        )
+    profiler.write()
+
+if __name__ == "__main__":
+    main()
@@ -1,57 +1,114 @@
 # b0_correction.py
 
+import os
+import time
+
 import numpy as np
-import matplotlib.pyplot as plt
 import SimpleITK as sitk
 import scipy.ndimage
 
-def formula(value):
-    """Converts the raw B0 map values into millimeter shifts."""
-    G_read_percentFLASH = 5.563298 / 100
-    PVM_GradCal = 42797.5
+from dtype_policy import DEFAULT_DTYPE, as_working_dtype
+from instrumentation import NULL_PROFILER, profiler_for
+from parallel_warp import parallel_zoom, set_number_of_threads, zoom_region
+from roi_mask import bounding_box, foreground_mask, roi_mask_image, target_mask
+
+def formula(value, G_read_percentFLASH=5.563298 / 100, PVM_GradCal=42797.5):
+    """Converts the raw B0 map values into millimeter shifts.
+
+    G_read_percentFLASH (read gradient as a fraction of the maximum) and
+    PVM_GradCal (gradient calibration in Hz/mm) depend on the sequence.
+    """
     new_value = value / (G_read_percentFLASH * PVM_GradCal)
     return new_value
 
-def main():
-    # ------------------------------
-    # 1. Load MR volume and B0 map
-    # ------------------------------
-    MR_Volume = sitk.ReadImage('b0_correction_analysis/Analysis_08_10_2024/mouse/mouse_35_MR.nii')
-    MR_Volume_Array = sitk.GetArrayFromImage(MR_Volume)
+def _as_float32(image):
+    """Casts image to float32 unless it already is."""
+    if image.GetPixelID() == sitk.sitkFloat32:
+        return image
+    return sitk.Cast(image, sitk.sitkFloat32)
 
-    B0_Map = sitk.ReadImage('b0_correction_analysis/Analysis_08_10_2024/mouse/B0_Map_Mouse.nii')
+def register_b0_map(MR_Volume, B0_Map, fast=False, mask=None, initial_transform=None, report=None,
+                    coarse_only=False):
+    """Rigidly registers the B0 map to the MR volume and resamples it onto the MR grid.
 
-    # ------------------------------
-    # 2. Registration
-    # ------------------------------
-    initial_transform = sitk.CenteredTransformInitializer(
-        MR_Volume,
-        B0_Map,
-        sitk.Euler3DTransform(),
-        sitk.CenteredTransformInitializerFilter.GEOMETRY
-    )
+    fast=True restricts the metric sampling to a foreground mask (Otsu
+    thresholding of the MR volume unless mask is given), skips the finest
+    pyramid level and stops each level as soon as the metric plateaus.
+    initial_transform warm-starts the optimiser, e.g. with the transform of
+    the previous scan of the same session. coarse_only=True runs the coarsest
+    pyramid level only, for quick previews. If report is a dict, it is filled
+    with the iteration count, metric value and time of each pyramid level.
+    """
+    if initial_transform is None:
+        initial_transform = sitk.CenteredTransformInitializer(
+            MR_Volume,
+            B0_Map,
+            sitk.Euler3DTransform(),
+            sitk.CenteredTransformInitializerFilter.GEOMETRY
+        )
 
     registration_method = sitk.ImageRegistrationMethod()
     registration_method.SetMetricAsMattesMutualInformation(numberOfHistogramBins=50)
     registration_method.SetMetricSamplingStrategy(registration_method.RANDOM)
     registration_method.SetMetricSamplingPercentage(0.01)
     registration_method.SetInterpolator(sitk.sitkLinear)
-    registration_method.SetOptimizerAsGradientDescent(
-        learningRate=1.0, numberOfIterations=100,
-        convergenceMinimumValue=1e-6, convergenceWindowSize=10
-    )
+    if fast:
+        registration_method.SetMetricFixedMask(mask if mask is not None else foreground_mask(MR_Volume))
+    elif mask is not None:
+        registration_method.SetMetricFixedMask(mask)
+    if fast or coarse_only:
+        registration_method.SetOptimizerAsGradientDescent(
+            learningRate=1.0, numberOfIterations=100,
+            convergenceMinimumValue=1e-4, convergenceWindowSize=5
+        )
+    else:
+        registration_method.SetOptimizerAsGradientDescent(
+            learningRate=1.0, numberOfIterations=100,
+            convergenceMinimumValue=1e-6, convergenceWindowSize=10
+        )
     registration_method.SetOptimizerScalesFromPhysicalShift()
 
     registration_method.SetInitialTransform(initial_transform, inPlace=False)
-    registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[4, 2, 1])
-    registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[2, 1, 0])
+    if coarse_only:
+        registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[4])
+        registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[2])
+    elif fast:
+        registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[4, 2])
+        registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[2, 1])
+    else:
+        registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[4, 2, 1])
+        registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[2, 1, 0])
     registration_method.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
 
+    if report is not None:
+        levels = report.setdefault('levels', [])
+
+        def end_level():
+            if levels and 'start' in levels[-1]:
+                level = levels[-1]
+                level['seconds'] = time.perf_counter() - level.pop('start')
+
+        def start_level():
+            end_level()
+            levels.append({'level': len(levels), 'iterations': 0, 'start': time.perf_counter()})
+
+        def iteration():
+            levels[-1]['iterations'] += 1
+            levels[-1]['metric'] = registration_method.GetMetricValue()
+
+        registration_method.AddCommand(sitk.sitkMultiResolutionIterationEvent, start_level)
+        registration_method.AddCommand(sitk.sitkIterationEvent, iteration)
+        registration_method.AddCommand(sitk.sitkEndEvent, end_level)
+
     final_transform = registration_method.Execute(
-        sitk.Cast(MR_Volume, sitk.sitkFloat32),
-        sitk.Cast(B0_Map, sitk.sitkFloat32)
+        _as_float32(MR_Volume),
+        _as_float32(B0_Map)
     )
 
+    if report is not None:
+        report['stop_condition'] = registration_method.GetOptimizerStopConditionDescription()
+        report['metric'] = registration_method.GetMetricValue()
+
     # Resample B0 map to align with MR volume
     B0_Map_Resampled = sitk.Resample(
         B0_Map,
@@ -61,44 +118,42 @@ def main():
         0.0,
         B0_Map.GetPixelID()
     )
+    return final_transform, B0_Map_Resampled
 
-    # ------------------------------
-    # 3. Upsampling
-    # ------------------------------
-    B0_Map_Resampled_Array = sitk.GetArrayFromImage(B0_Map_Resampled)
-    MR_Volume_Array = sitk.GetArrayFromImage(MR_Volume)
-
-    original_shape = B0_Map_Resampled_Array.shape
-    target_shape = (112, 128, 128)  # Adjust if needed
-    zoom_factors = (
-        target_shape[0] / original_shape[0],
-        target_shape[1] / original_shape[1],
-        target_shape[2] / original_shape[2]
-    )
-
-    B0_Map_Upsampled_Array = scipy.ndimage.zoom(B0_Map_Resampled_Array, zoom_factors, order=3)
-    MR_Volume_Upsampled_Array = scipy.ndimage.zoom(MR_Volume_Array, zoom_factors, order=3)
-
-    B0_Map_Upsampled = sitk.GetImageFromArray(B0_Map_Upsampled_Array)
-    MR_Volume_Upsampled = sitk.GetImageFromArray(MR_Volume_Upsampled_Array)
-
-    B0_Map_Upsampled.SetOrigin(B0_Map.GetOrigin())
-    B0_Map_Upsampled.SetSpacing([
-        orig_sp / zf for orig_sp, zf in zip(B0_Map.GetSpacing(), zoom_factors)
+def upsampled_geometry(image, array_shape, target_shape):
+    """Empty image of target_shape with the geometry upsample_image gives an array of array_shape."""
+    zoom_factors = tuple(t / s for t, s in zip(target_shape, array_shape))
+    upsampled = sitk.Image([int(n) for n in target_shape[::-1]], sitk.sitkUInt8)
+    upsampled.SetOrigin(image.GetOrigin())
+    upsampled.SetSpacing([
+        orig_sp / zf for orig_sp, zf in zip(image.GetSpacing(), zoom_factors)
     ])
-    B0_Map_Upsampled.SetDirection(B0_Map.GetDirection())
+    upsampled.SetDirection(image.GetDirection())
+    return upsampled
 
-    MR_Volume_Upsampled.SetOrigin(MR_Volume.GetOrigin())
-    MR_Volume_Upsampled.SetSpacing([
-        orig_sp / zf for orig_sp, zf in zip(MR_Volume.GetSpacing(), zoom_factors)
-    ])
-    MR_Volume_Upsampled.SetDirection(MR_Volume.GetDirection())
+def region_geometry(image, region):
+    """Empty image with the geometry of a region (tuple of (z, y, x) slices) of image."""
+    cropped = sitk.Image([r.stop - r.start for r in region[::-1]], sitk.sitkUInt8)
+    cropped.SetOrigin(image.TransformIndexToPhysicalPoint([r.start for r in region[::-1]]))
+    cropped.SetSpacing(image.GetSpacing())
+    cropped.SetDirection(image.GetDirection())
+    return cropped
 
-    # ------------------------------
-    # 4. Create displacement field
-    # ------------------------------
-    B0_Map_Array_mm = formula(B0_Map_Upsampled_Array)
+def upsample_image(image, array, target_shape, workers=1, dtype=DEFAULT_DTYPE):
+    """Upsamples an array to target_shape and wraps it in an image with matching geometry."""
+    zoom_factors = tuple(t / s for t, s in zip(target_shape, array.shape))
+    array = as_working_dtype(array, dtype)
+
+    if workers == 1:
+        upsampled_array = scipy.ndimage.zoom(array, zoom_factors, order=3)
+    else:
+        upsampled_array = parallel_zoom(array, zoom_factors, order=3, workers=workers)
+    upsampled = sitk.GetImageFromArray(upsampled_array)
+    upsampled.CopyInformation(upsampled_geometry(image, array.shape, target_shape))
+    return upsampled_array, upsampled
 
+def apply_b0_displacement(MR_Volume_Upsampled, B0_Map_Array_mm):
+    """Resamples the MR volume with a z-only displacement field given in mm."""
     # Assuming shift is in z-direction
     deformation_field = np.zeros(B0_Map_Array_mm.shape + (3,), dtype=np.float64)
     deformation_field[..., 2] = B0_Map_Array_mm
@@ -107,32 +162,262 @@ def main():
     deformation_field_sitk = sitk.Cast(deformation_field_sitk, sitk.sitkVectorFloat64)
     deformation_field_sitk.CopyInformation(MR_Volume_Upsampled)
 
-    # ------------------------------
-    # 5. Apply displacement field
-    # ------------------------------
     resampler = sitk.ResampleImageFilter()
     resampler.SetReferenceImage(MR_Volume_Upsampled)
     resampler.SetInterpolator(sitk.sitkBSpline)
     resampler.SetDefaultPixelValue(0)
     resampler.SetTransform(sitk.DisplacementFieldTransform(deformation_field_sitk))
 
-    corrected_volume = resampler.Execute(MR_Volume_Upsampled)
-    corrected_volume_array = sitk.GetArrayFromImage(corrected_volume)
+    return resampler.Execute(MR_Volume_Upsampled)
 
-    # ------------------------------
-    # 6. Save results and visualize
-    # ------------------------------
-    sitk.WriteImage(corrected_volume, 'b0_correction_analysis/Analysis_08_10_2024/mouse/mouse_35_mr_b0_corrected.nii')
+def b0_shift_axis(image, axis=None):
+    """Returns (array axis, signed spacing) along which the B0 shift moves the samples of image.
+
+    With axis (the frequency-encoding array axis in (z, y, x) order) the
+    shift runs along that axis and in its index direction. Without it the
+    frequency-encoding direction is physical z, which must be aligned with a
+    single array axis, as for identity, flipped or permuted directions; the
+    spacing (mm per index step) is then negative when that axis points along
+    -z. Returns None for oblique directions.
+    """
+    if axis is not None:
+        if axis not in (0, 1, 2):
+            raise ValueError(f"frequency_encoding_axis must be 0, 1 or 2 (z, y, x), got {axis!r}")
+        return int(axis), float(image.GetSpacing()[::-1][axis])
+
+    direction = np.array(image.GetDirection()).reshape(3, 3)
+    index_to_physical = direction @ np.diag(image.GetSpacing())
+    # Continuous index step (z, y, x) produced by a 1 mm shift along physical z
+    step = np.linalg.solve(index_to_physical, [0.0, 0.0, 1.0])[::-1]
+    aligned = np.flatnonzero(np.abs(step) > 1e-6 * np.abs(step).max())
+    if aligned.size != 1:
+        return None
+    return int(aligned[0]), float(1.0 / step[aligned[0]])
+
+def apply_b0_shift(MR_Volume_Upsampled, volume_array, B0_Map_Array_mm, frequency_encoding_axis=None,
+                   dtype=DEFAULT_DTYPE, mask=None):
+    """Applies a B0 shift in mm to volume_array on the grid of MR_Volume_Upsampled.
+
+    The shift runs through apply_b0_shift_1d along frequency_encoding_axis,
+    or without it along the array axis aligned with physical z, with the
+    sign and spacing of that axis from the direction matrix (b0_shift_axis).
+    Only if frequency_encoding_axis is None and physical z is not aligned
+    with an array axis does it use the 3-D SimpleITK resample along physical
+    z (apply_b0_displacement). mask sets the voxels outside it to 0.
+    """
+    shift_axis = b0_shift_axis(MR_Volume_Upsampled, frequency_encoding_axis)
+    if shift_axis is not None:
+        axis, spacing = shift_axis
+        return apply_b0_shift_1d(volume_array, B0_Map_Array_mm, spacing, axis=axis, dtype=dtype, mask=mask)
+
+    volume = sitk.GetImageFromArray(as_working_dtype(volume_array, dtype))
+    volume.CopyInformation(MR_Volume_Upsampled)
+    corrected_volume_array = sitk.GetArrayFromImage(apply_b0_displacement(volume, B0_Map_Array_mm))
+    if mask is not None:
+        corrected_volume_array[~mask] = 0
+    return corrected_volume_array
+
+def b0_shift_region(box, geometry, max_shift_mm, frequency_encoding_axis=None, halo=16):
+    """Region (tuple of slices) of the grid of geometry needed to B0-correct the voxels in box.
+
+    box (the bounding box of a region of interest, see roi_mask) is extended
+    by the largest shift plus halo voxels along the array axis the shift acts
+    on, or along every axis for the 3-D resample, so neither the shifted
+    samples nor the spline prefilter reach past the region.
+    """
+    shift_axis = b0_shift_axis(geometry, frequency_encoding_axis)
+    spacing = geometry.GetSpacing()[::-1]
+    size = geometry.GetSize()[::-1]
+    region = []
+    for axis, rows in enumerate(box):
+        margin = 0
+        if shift_axis is None or shift_axis[0] == axis:
+            margin = int(np.ceil(max_shift_mm / spacing[axis])) + halo
+        region.append(slice(max(rows.start - margin, 0), min(rows.stop + margin, size[axis])))
+    return tuple(region)
+
+def _cubic_bspline_weights(t):
+    """Cubic B-spline weights of the four taps at offsets -1, 0, 1, 2 for fractions t."""
+    t2 = t * t
+    t3 = t2 * t
+    return (
+        (1 - t) ** 3 / 6,
+        (3 * t3 - 6 * t2 + 4) / 6,
+        (-3 * t3 + 3 * t2 + 3 * t + 1) / 6,
+        t3 / 6,
+    )
 
-    # Quick visualization
-    mid_slice_MR = MR_Volume_Upsampled_Array.shape[0] // 2
+def _mirror_index(index, n):
+    """Folds integer indices back into [0, n) with whole-sample mirror boundaries."""
+    if n == 1:
+        return np.zeros_like(index)
+    period = 2 * (n - 1)
+    index = np.abs(index) % period
+    return np.where(index >= n, period - index, index)
+
+def apply_b0_shift_1d(volume_array, B0_Map_Array_mm, spacing, axis=0, default_value=0.0,
+                      dtype=DEFAULT_DTYPE, mask=None):
+    """Shifts the volume along the frequency-encoding axis with 1-D cubic B-spline interpolation.
+
+    B0 displacements act along a single axis only, so instead of building a
+    3-vector displacement field and running a 3-D resample, every line along
+    that array axis is interpolated in 1-D. The result matches the
+    DisplacementFieldTransform B-spline resample: the sample at i is taken at
+    i + shift / spacing, and samples mapped outside the volume get
+    default_value. spacing is signed, negative for an axis pointing against
+    the shift (see b0_shift_axis). The interpolation runs in dtype. mask
+    (boolean, volume shape, see roi_mask) skips the lines without any voxel
+    inside it and sets all voxels outside it to default_value.
+    """
+    dtype = np.dtype(dtype)
+    coefficients = scipy.ndimage.spline_filter1d(
+        volume_array, order=3, axis=axis, output=dtype, mode='mirror'
+    )
+    # Work on views with the shift axis last, one plane of lines at a time
+    coefficients = np.moveaxis(coefficients, axis, -1)
+    shifts = np.moveaxis(B0_Map_Array_mm, axis, -1)
+    if mask is not None:
+        mask = np.moveaxis(mask, axis, -1)
+    corrected = np.empty(coefficients.shape, dtype=dtype)
+
+    n = coefficients.shape[-1]
+    positions = np.arange(n, dtype=dtype)
+    for plane in range(coefficients.shape[0]):
+        lines = slice(None)
+        if mask is not None:
+            corrected[plane] = default_value
+            lines = np.flatnonzero(mask[plane].any(axis=-1))
+            if lines.size == 0:
+                continue
+        x = positions + as_working_dtype(shifts[plane][lines], dtype) / dtype.type(spacing)
+        base = np.floor(x)
+        weights = _cubic_bspline_weights(x - base)
+        base = base.astype(np.intp)
+
+        plane_coefficients = coefficients[plane][lines]
+        values = np.zeros(x.shape, dtype=dtype)
+        for offset, weight in zip(range(-1, 3), weights):
+            values += weight * np.take_along_axis(plane_coefficients, _mirror_index(base + offset, n), axis=-1)
+
+        # Same inside-buffer test as the SimpleITK resampler
+        values[(x < -0.5) | (x >= n - 0.5)] = default_value
+        if mask is not None:
+            values[~mask[plane][lines]] = default_value
+        corrected[plane][lines] = values
+
+    return np.moveaxis(corrected, -1, axis)
+
+def correct_b0(image, field_map, params=None, target_shape=(112, 128, 128), workers=1,
+               frequency_encoding_axis=None, fast_registration=False, initial_transform=None,
+               report=None, profiler=NULL_PROFILER, dtype=DEFAULT_DTYPE, roi=None):
+    """Registers the B0 map, upsamples both images and corrects the B0 shift, all in memory.
+
+    params holds the sequence constants passed to formula (G_read_percentFLASH,
+    PVM_GradCal); missing keys keep their defaults. Returns the corrected image
+    on the upsampled grid. The B0 shift acts along frequency_encoding_axis
+    (an array axis in (z, y, x) order), or by default along physical z with
+    the array axis and sign from the image direction (apply_b0_shift). If
+    report is a dict it receives the registration report, the final
+    transform under 'transform', and the upsampled MR volume and B0 shift
+    under 'MR_Volume_Upsampled_Array' and 'B0_Map_Array_mm', for
+    plot_b0_correction. roi ('auto', a bounding box or a mask, see roi_mask)
+    restricts the B0 shift to a region of interest; the upsampling and the
+    shift then only run on its bounding box plus the margin of
+    b0_shift_region, and everything outside is 0. The registration always
+    uses the whole image, so inside the region the result is that of the
+    full correction.
+    """
+    params = params or {}
+    if report is None:
+        report = {}
+    mask_image = roi_mask_image(image, roi)
+    with profiler.stage('registration'):
+        final_transform, B0_Map_Resampled = register_b0_map(
+            image, field_map, fast=fast_registration, initial_transform=initial_transform,
+            report=report
+        )
+    report['transform'] = final_transform
+
+    if mask_image is not None:
+        return _correct_b0_region(
+            image, B0_Map_Resampled, target_mask(mask_image, target_shape), params, target_shape,
+            workers, frequency_encoding_axis, report, profiler, dtype
+        )
+
+    with profiler.stage('upsampling'):
+        B0_Map_Upsampled_Array, _ = upsample_image(
+            field_map, sitk.GetArrayViewFromImage(B0_Map_Resampled), target_shape, workers, dtype
+        )
+        MR_Volume_Upsampled_Array, MR_Volume_Upsampled = upsample_image(
+            image, sitk.GetArrayViewFromImage(image), target_shape, workers, dtype
+        )
+
+    with profiler.stage('field_construction'):
+        B0_Map_Array_mm = formula(B0_Map_Upsampled_Array, **params)
+
+    with profiler.stage('b0_resample'):
+        corrected_volume_array = apply_b0_shift(
+            MR_Volume_Upsampled, MR_Volume_Upsampled_Array, B0_Map_Array_mm, frequency_encoding_axis,
+            dtype=dtype
+        )
+    corrected_volume = sitk.GetImageFromArray(corrected_volume_array)
+    corrected_volume.CopyInformation(MR_Volume_Upsampled)
+
+    report['MR_Volume_Upsampled_Array'] = MR_Volume_Upsampled_Array
+    report['B0_Map_Array_mm'] = B0_Map_Array_mm
+    return corrected_volume
+
+def _correct_b0_region(image, B0_Map_Resampled, mask, params, target_shape, workers,
+                       frequency_encoding_axis, report, profiler, dtype):
+    """Upsampling and B0 shift of correct_b0 restricted to the region around a target-grid mask."""
+    dtype = np.dtype(dtype)
+    MR_Volume_Upsampled = upsampled_geometry(image, image.GetSize()[::-1], target_shape)
+    MR_Volume_Upsampled_Array = np.zeros(target_shape, dtype=dtype)
+    B0_Map_Array_mm = np.zeros(target_shape, dtype=dtype)
+    corrected_volume_array = np.zeros(target_shape, dtype=dtype)
+
+    box = bounding_box(mask)
+    if box is not None:
+        B0_Map_Resampled_Array = as_working_dtype(sitk.GetArrayViewFromImage(B0_Map_Resampled), dtype)
+        # The shift of the upsampled map stays close to that of the registered map;
+        # the halo of b0_shift_region covers the spline overshoot
+        max_shift_mm = float(np.abs(formula(B0_Map_Resampled_Array, **params)).max())
+        region = b0_shift_region(box, MR_Volume_Upsampled, max_shift_mm, frequency_encoding_axis)
+
+        with profiler.stage('upsampling'):
+            B0_Map_Upsampled_Array = zoom_region(B0_Map_Resampled_Array, target_shape, region, workers=workers)
+            MR_Volume_Upsampled_Array[region] = zoom_region(
+                as_working_dtype(sitk.GetArrayViewFromImage(image), dtype), target_shape, region, workers=workers
+            )
+
+        with profiler.stage('field_construction'):
+            B0_Map_Array_mm[region] = formula(B0_Map_Upsampled_Array, **params)
+
+        with profiler.stage('b0_resample'):
+            corrected_volume_array[region] = apply_b0_shift(
+                region_geometry(MR_Volume_Upsampled, region), MR_Volume_Upsampled_Array[region],
+                B0_Map_Array_mm[region], frequency_encoding_axis, dtype=dtype, mask=mask[region]
+            )
+
+    corrected_volume = sitk.GetImageFromArray(corrected_volume_array)
+    corrected_volume.CopyInformation(MR_Volume_Upsampled)
+    report['MR_Volume_Upsampled_Array'] = MR_Volume_Upsampled_Array
+    report['B0_Map_Array_mm'] = B0_Map_Array_mm
+    return corrected_volume
+
+def plot_b0_correction(MR_Volume_Array, B0_Map_Array_mm, corrected_volume_array, show=True):
+    """Shows the mid slices of the MR volume, the B0 shift and the corrected volume."""
+    # Imported here so headless runs never load matplotlib
+    import matplotlib.pyplot as plt
+
+    mid_slice_MR = MR_Volume_Array.shape[0] // 2
     mid_slice_B0 = B0_Map_Array_mm.shape[0] // 2
     mid_slice_corrected = corrected_volume_array.shape[0] // 2
 
-    plt.figure(figsize=(12, 6))
+    figure = plt.figure(figsize=(12, 6))
     plt.subplot(1, 3, 1)
     plt.title("Original MR Slice")
-    plt.imshow(MR_Volume_Upsampled_Array[mid_slice_MR], cmap='gray')
+    plt.imshow(MR_Volume_Array[mid_slice_MR], cmap='gray')
 
     plt.subplot(1, 3, 2)
     plt.title("Displacement Field (Z-shift)")
@@ -142,7 +427,73 @@ def main():
     plt.title("Corrected MR Slice")
     plt.imshow(corrected_volume_array[mid_slice_corrected], cmap='gray')
 
-    plt.show()
+    if show:
+        plt.show()
+    return figure
+
+def main():
+    # Use every core for the zoom upsampling and the SimpleITK filters
+    workers = os.cpu_count()
+    set_number_of_threads(workers)
+
+    # Per-stage timings and memory, written when DISTORTION_CORRECTION_PROFILE is set
+    profiler = profiler_for('mouse_35')
+
+    # ------------------------------
+    # 1. Load MR volume and B0 map
+    # ------------------------------
+    with profiler.stage('load'):
+        MR_Volume = sitk.ReadImage('b0_correction_analysis/Analysis_08_10_2024/mouse/mouse_35_MR.nii')
+        B0_Map = sitk.ReadImage('b0_correction_analysis/Analysis_08_10_2024/mouse/B0_Map_Mouse.nii')
+
+    # ------------------------------
+    # 2. Registration, upsampling and B0 shift
+    # ------------------------------
+    # Set fast_registration to sample the metric inside the foreground only and
+    # stop at the metric plateau; a transform saved from the previous scan of
+    # the same session can be used as a warm start. The B0 shift acts along
+    # physical z, with the array axis following from the image direction;
+    # set frequency_encoding_axis (an array axis in (z, y, x) order) for
+    # another frequency-encoding direction.
+    fast_registration = False
+    warm_start_transform_path = None
+    initial_transform = None
+    if warm_start_transform_path is not None:
+        initial_transform = sitk.ReadTransform(warm_start_transform_path)
+
+    registration_report = {}
+    corrected_volume = correct_b0(
+        MR_Volume, B0_Map,
+        target_shape=(112, 128, 128),  # Adjust if needed
+        workers=workers,
+        frequency_encoding_axis=None,
+        fast_registration=fast_registration,
+        initial_transform=initial_transform,
+        report=registration_report,
+        profiler=profiler
+    )
+    for level in registration_report['levels']:
+        print(f"Registration level {level['level']}: {level['iterations']} iterations, "
+              f"{level['seconds']:.2f} s")
+    sitk.WriteTransform(
+        registration_report['transform'],
+        'b0_correction_analysis/Analysis_08_10_2024/mouse/mouse_35_b0_to_mr.tfm'
+    )
+
+    # ------------------------------
+    # 3. Save results
+    # ------------------------------
+    with profiler.stage('write'):
+        sitk.WriteImage(corrected_volume, 'b0_correction_analysis/Analysis_08_10_2024/mouse/mouse_35_mr_b0_corrected.nii')
+    profiler.write()
+
+    # ------------------------------
+    # 4. Plot the mid slices
+    # ------------------------------
+    plot_b0_correction(
+        registration_report['MR_Volume_Upsampled_Array'], registration_report['B0_Map_Array_mm'],
+        sitk.GetArrayViewFromImage(corrected_volume)
+    )
 
 if __name__ == "__main__":
     main()
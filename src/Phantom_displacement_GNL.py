@@ -1,68 +1,259 @@
 # phantom_displacement.py
 
+import os
+
 import numpy as np
 import SimpleITK as sitk
 import scipy.ndimage
 from scipy.ndimage import map_coordinates
 
-def main():
-    # 1. Load the B0-corrected mouse MR volume
-    Mouse_Rigid_B0 = sitk.ReadImage(
-        'b0_correction_analysis/Analysis_08_10_2024/mouse/mouse_35_mr_b0_corrected.nii'
-    )
-    Mouse_Rigid_B0_Array = sitk.GetArrayFromImage(Mouse_Rigid_B0)
+from dtype_policy import DEFAULT_DTYPE
+from gnl_field_cache import resample_phantom_field, resample_phantom_field_cached
+from instrumentation import NULL_PROFILER, profiler_for
+from nifti_mmap import create_nifti_memmap, is_uncompressed_nifti, read_image_information, read_nifti_memmap
+from parallel_warp import parallel_map_coordinates
+from roi_mask import bounding_box, roi_mask_image, target_mask
 
-    # 2. Load the cropped phantom displacement field
-    Phantom_Displacement_Field = sitk.ReadImage(
-        'b0_correction_analysis/Analysis_08_10_2024/mouse/Cropped_Displacement_Field_Mouse_Dimensions.nii'
-    )
-    Phantom_Displacement_Field_Array = sitk.GetArrayFromImage(Phantom_Displacement_Field)
-
-    # 3. Create mesh grid for the original coordinates
-    nx, ny, nz = Mouse_Rigid_B0_Array.shape
-    x = np.arange(nx)
-    y = np.arange(ny)
-    z = np.arange(nz)
-    X, Y, Z = np.meshgrid(x, y, z, indexing='ij')
-
-    # 4. Resample the phantom displacement field to match the MRI volume shape
-    zoom_factors = (
-        Mouse_Rigid_B0_Array.shape[0] / Phantom_Displacement_Field_Array.shape[0],
-        Mouse_Rigid_B0_Array.shape[1] / Phantom_Displacement_Field_Array.shape[1],
-        Mouse_Rigid_B0_Array.shape[2] / Phantom_Displacement_Field_Array.shape[2],
-    )
+def apply_phantom_field(volume_array, field_array_resampled, workers=1, dtype=DEFAULT_DTYPE, mask=None):
+    """Shifts every voxel of volume_array by the (voxel unit) phantom displacement field.
 
-    Phantom_Displacement_Field_Array_Resampled = np.zeros(Mouse_Rigid_B0_Array.shape + (3,))
-    for i in range(3):
-        Phantom_Displacement_Field_Array_Resampled[..., i] = scipy.ndimage.zoom(
-            Phantom_Displacement_Field_Array[..., i],
-            zoom_factors,
-            order=3
+    With workers > 1 the interpolation runs block-parallel, bit-identical to
+    the serial result. Coordinates are built in dtype. mask (boolean, volume
+    shape, see roi_mask) restricts the warp to the voxels inside it; all
+    other voxels get 0.
+    """
+    # A BSplineField is evaluated once here
+    field_array_resampled = np.asarray(field_array_resampled)
+
+    if mask is not None:
+        # Coordinates of the voxels inside the mask only
+        index = np.nonzero(mask)
+        displaced = [
+            index[i].astype(dtype) + field_array_resampled[..., i][index] for i in range(3)
+        ]
+    else:
+        # Create mesh grid for the original coordinates
+        nx, ny, nz = volume_array.shape
+        x = np.arange(nx, dtype=dtype)
+        y = np.arange(ny, dtype=dtype)
+        z = np.arange(nz, dtype=dtype)
+        X, Y, Z = np.meshgrid(x, y, z, indexing='ij')
+
+        displaced = [
+            X + field_array_resampled[..., 0],
+            Y + field_array_resampled[..., 1],
+            Z + field_array_resampled[..., 2],
+        ]
+
+    if workers != 1:
+        values = parallel_map_coordinates(
+            volume_array,
+            displaced,
+            order=3,
+            mode='reflect',
+            workers=workers
         )
+    else:
+        values = map_coordinates(
+            volume_array,
+            displaced,
+            order=3,
+            mode='reflect'
+        )
+    if mask is None:
+        return values
+    corrected = np.zeros(volume_array.shape, dtype=values.dtype)
+    corrected[index] = values
+    return corrected
 
-    # 5. Apply the displacement field
-    displaced_X = X + Phantom_Displacement_Field_Array_Resampled[..., 0]
-    displaced_Y = Y + Phantom_Displacement_Field_Array_Resampled[..., 1]
-    displaced_Z = Z + Phantom_Displacement_Field_Array_Resampled[..., 2]
-
-    # 6. Interpolate the B0-corrected volume with the phantom displacement
-    Mouse_Rigid_B0_with_Phantom_Displacement_Field = map_coordinates(
-        Mouse_Rigid_B0_Array,
-        [displaced_X, displaced_Y, displaced_Z],
-        order=3,
-        mode='reflect'
-    )
+def _reflected_extent(lo, hi, n):
+    """Input index range [lo, hi] covered by coordinates after scipy 'reflect' folding."""
+    if lo < 0:
+        hi = max(hi, -1 - lo)
+        lo = 0
+    if hi > n - 1:
+        lo = min(lo, 2 * n - 1 - hi)
+        hi = n - 1
+    return max(lo, 0), min(hi, n - 1)
 
-    # 7. Convert back to a SimpleITK image and save
-    Mouse_Rigid_B0_with_Phantom_Displacement_Field_Volume = sitk.GetImageFromArray(
-        Mouse_Rigid_B0_with_Phantom_Displacement_Field
-    )
-    Mouse_Rigid_B0_with_Phantom_Displacement_Field_Volume.CopyInformation(Mouse_Rigid_B0)
+def apply_phantom_field_slabs(volume_array, field_array_resampled, memory_budget_bytes,
+                              output=None, halo=16, dtype=DEFAULT_DTYPE, mask=None):
+    """Slab-streamed version of apply_phantom_field with bounded peak memory.
+
+    The output is processed in slabs along the first array axis. For each slab
+    the sampling coordinates are generated on the fly, and only the input
+    block they reach (plus a halo for the cubic spline prefilter) is
+    prefiltered and interpolated. The halo keeps the difference to the
+    whole-volume result below ~1e-9 of the intensity range. output may be a
+    preallocated (e.g. memory-mapped) array of the volume's shape. mask
+    restricts the interpolation to the voxels inside it, as in
+    apply_phantom_field; the coordinates are then built, and the field read,
+    only within the bounding box of the mask in each slab.
+    """
+    dtype = np.dtype(dtype)
+    n0, n1, n2 = volume_array.shape
+    plane = n1 * n2
+    if output is None:
+        output = np.empty(volume_array.shape, dtype=volume_array.dtype)
+
+    # Largest displacement along the slab axis, to size the input blocks
+    extent = 0
+    for z0 in range(0, n0, 8):
+        extent = max(extent, float(np.abs(field_array_resampled[z0:z0 + 8, ..., 0]).max()))
+    extent = int(np.ceil(extent))
+
+    # Per output plane: coordinates, interpolated values, field slab, input block
+    bytes_per_plane = plane * (3 * dtype.itemsize + 8 + field_array_resampled.itemsize * 3
+                               + volume_array.itemsize + 8)
+    block_overhead = (2 * halo + 2 * extent + 4) * plane * (volume_array.itemsize + 8)
+    slab = max(1, int((memory_budget_bytes - block_overhead) // bytes_per_plane))
+
+    for z0 in range(0, n0, slab):
+        z1 = min(z0 + slab, n0)
+        region = (slice(z0, z1), slice(0, n1), slice(0, n2))
+        if mask is not None:
+            output[z0:z1] = 0
+            box = bounding_box(mask[z0:z1])
+            if box is None:
+                continue
+            region = (slice(z0 + box[0].start, z0 + box[0].stop),) + box[1:]
+
+        field = field_array_resampled[region]
+        z, y, x = (np.arange(r.start, r.stop, dtype=dtype) for r in region)
+        coordinates = np.empty((3,) + field.shape[:3], dtype=dtype)
+        coordinates[0] = z[:, None, None] + field[..., 0]
+        coordinates[1] = y[None, :, None] + field[..., 1]
+        coordinates[2] = x[None, None, :] + field[..., 2]
+
+        lo, hi = _reflected_extent(
+            int(np.floor(coordinates[0].min())), int(np.ceil(coordinates[0].max())), n0
+        )
+        block_lo = max(lo - halo, 0)
+        block_hi = min(hi + 1 + halo, n0)
+        coefficients = scipy.ndimage.spline_filter(
+            volume_array[block_lo:block_hi], order=3, output=np.float64, mode='reflect'
+        )
+        coordinates[0] -= block_lo
+
+        if mask is None:
+            output[z0:z1] = map_coordinates(
+                coefficients, coordinates, order=3, mode='reflect', prefilter=False
+            )
+            continue
+        inside = mask[region]
+        values = np.zeros(inside.shape, dtype=output.dtype)
+        values[inside] = map_coordinates(
+            coefficients, coordinates[:, inside], order=3, mode='reflect', prefilter=False
+        )
+        output[region] = values
+    return output
+
+def correct_gnl(image, field, workers=1, memory_budget_bytes=None, profiler=NULL_PROFILER,
+                dtype=DEFAULT_DTYPE, roi=None, roi_image=None):
+    """Corrects the gradient non-linearity of an in-memory image and returns the corrected image.
+
+    field is the phantom displacement field in voxel units, as a vector image,
+    a (z, y, x, 3) array or a BSplineField; it is resampled to the grid of
+    image unless it already has that shape. With memory_budget_bytes the warp
+    is streamed in slabs (apply_phantom_field_slabs). roi ('auto', a bounding
+    box or a mask, see roi_mask) restricts the warp to a region of interest.
+    It is given on the grid of roi_image (default: image) and mapped onto
+    image with target_mask; in the two-step chain roi_image is the acquired
+    MR volume, so the same roi selects the same region as in correct_b0.
+    """
+    volume_array = sitk.GetArrayFromImage(image).astype(dtype, copy=False)
+    field_array = sitk.GetArrayFromImage(field) if isinstance(field, sitk.Image) else field
+    if field_array.shape[:3] != volume_array.shape:
+        with profiler.stage('gnl_field_resampling'):
+            field_array = resample_phantom_field(field_array, volume_array.shape, dtype)
+
+    mask = None
+    if roi is not None:
+        roi_image = image if roi_image is None else roi_image
+        mask = target_mask(roi_mask_image(roi_image, roi), volume_array.shape)
+
+    with profiler.stage('gnl_warp'):
+        if memory_budget_bytes is None:
+            corrected_array = apply_phantom_field(
+                volume_array, field_array, workers=workers, dtype=dtype, mask=mask
+            )
+        else:
+            corrected_array = apply_phantom_field_slabs(
+                volume_array, field_array, memory_budget_bytes, dtype=dtype, mask=mask
+            )
+
+    corrected = sitk.GetImageFromArray(corrected_array)
+    corrected.CopyInformation(image)
+    return corrected
 
-    sitk.WriteImage(
-        Mouse_Rigid_B0_with_Phantom_Displacement_Field_Volume,
-        "b0_correction_analysis/Analysis_08_10_2024/mouse/Mouse_B0_Corrected_with_Phantom_Displacement_Field_Volume_MR_resolution.nii"
+def correct_gnl_file(input_path, field_path, output_path, memory_budget_bytes, halo=16,
+                     profiler=NULL_PROFILER, dtype=DEFAULT_DTYPE):
+    """Out-of-core GNL correction of a volume file with bounded peak memory.
+
+    An uncompressed .nii input is memory-mapped instead of read, the phantom
+    field comes memory-mapped from the on-disk cache, and the corrected slabs
+    are written straight into a preallocated memory-mapped .nii output, so the
+    volume never has to fit in memory as a whole. The output is written in
+    dtype, whatever the input data type, so integer scans are not truncated.
+    """
+    geometry = read_image_information(input_path)
+    with profiler.stage('load'):
+        if is_uncompressed_nifti(input_path):
+            volume_array = read_nifti_memmap(input_path)
+        else:
+            volume_array = sitk.GetArrayFromImage(sitk.ReadImage(input_path))
+
+    with profiler.stage('gnl_field_resampling'):
+        field_array = resample_phantom_field_cached(
+            field_path, geometry, geometry.GetSize()[::-1], dtype=dtype
+        )
+
+    with profiler.stage('gnl_warp'):
+        output = create_nifti_memmap(output_path, geometry, dtype)
+        apply_phantom_field_slabs(
+            volume_array, field_array, memory_budget_bytes, output=output, halo=halo, dtype=dtype
+        )
+        output.flush()
+    del output
+
+def main():
+    # Per-stage timings and memory, written when DISTORTION_CORRECTION_PROFILE is set
+    profiler = profiler_for('mouse_35')
+
+    input_path = 'b0_correction_analysis/Analysis_08_10_2024/mouse/mouse_35_mr_b0_corrected.nii'
+    field_path = 'b0_correction_analysis/Analysis_08_10_2024/mouse/Cropped_Displacement_Field_Mouse_Dimensions.nii'
+    output_path = "b0_correction_analysis/Analysis_08_10_2024/mouse/Mouse_B0_Corrected_with_Phantom_Displacement_Field_Volume_MR_resolution.nii"
+
+    # Set a memory budget (e.g. 4 * 1024 ** 3) to stream the warp in slabs for
+    # volumes that do not fit in memory: the input is memory-mapped and the
+    # output is written slab by slab into a memory-mapped NIfTI file.
+    memory_budget_bytes = None
+    if memory_budget_bytes is not None:
+        correct_gnl_file(input_path, field_path, output_path, memory_budget_bytes, profiler=profiler)
+        profiler.write()
+        return
+
+    # 1. Load the B0-corrected mouse MR volume
+    with profiler.stage('load'):
+        Mouse_Rigid_B0 = sitk.ReadImage(input_path)
+
+    # 2. Resample the cropped phantom displacement field to match the MRI volume
+    #    shape; the result is cached on disk per target geometry
+    with profiler.stage('gnl_field_resampling'):
+        Phantom_Displacement_Field_Array_Resampled = resample_phantom_field_cached(
+            field_path, Mouse_Rigid_B0
+        )
+
+    # 3. Apply the displacement field and interpolate the B0-corrected volume
+    Mouse_Rigid_B0_with_Phantom_Displacement_Field_Volume = correct_gnl(
+        Mouse_Rigid_B0, Phantom_Displacement_Field_Array_Resampled,
+        workers=os.cpu_count(), profiler=profiler
     )
 
+    # 4. Save
+    with profiler.stage('write'):
+        sitk.WriteImage(Mouse_Rigid_B0_with_Phantom_Displacement_Field_Volume, output_path)
+    profiler.write()
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,130 @@
+# array_store.py
+#
+# Optional chunked, compressed output backend. Corrected volumes are stored
+# as zarr arrays with the image geometry in the array attributes;
+# write_volume also takes (z, y, x, components) arrays, so the batch and
+# session runners can store the resampled GNL field and the B0 shift maps
+# next to the outputs (--store-fields, see field_store_path). Chunks are compressed in
+# parallel (one chunk-aligned block per thread), and a region or a few slices
+# can be read back without decompressing the whole volume. Paths ending in .zarr select
+# this backend in write_output; everything else is written with SimpleITK.
+#
+# Requires zarr (pip install zarr).
+
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import SimpleITK as sitk
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+DEFAULT_CHUNKS = (16, 64, 64)
+
+def _require_zarr():
+    if zarr is None:
+        raise ImportError("The .zarr output backend requires zarr (pip install zarr)")
+
+def is_array_store(path):
+    """True for paths handled by this backend."""
+    return str(path).rstrip('/').endswith('.zarr')
+
+def field_store_path(store_dir, output_path, name):
+    """Returns the zarr path in store_dir of the field name belonging to output_path.
+
+    E.g. ('fields', 'results/mouse_35_b0_gnl.nii', 'b0_shift_mm') gives
+    'fields/mouse_35_b0_gnl_b0_shift_mm.zarr'.
+    """
+    stem = os.path.basename(str(output_path).rstrip('/')).split('.')[0]
+    return os.path.join(store_dir, f"{stem}_{name}.zarr")
+
+def write_volume(path, array, geometry=None, chunks=DEFAULT_CHUNKS, workers=None):
+    """Writes a (z, y, x) or (z, y, x, components) array as a chunked, compressed zarr array.
+
+    geometry is a SimpleITK image (or anything with GetSpacing, GetOrigin and
+    GetDirection) whose geometry is stored in the attributes. Vector
+    components are kept together in every chunk. Chunk-aligned slabs along z
+    are compressed and written on a thread pool.
+    """
+    _require_zarr()
+    workers = workers or os.cpu_count()
+    array = np.asarray(array)
+    chunks = tuple(min(c, n) for c, n in zip(chunks, array.shape[:3])) + array.shape[3:]
+
+    store = zarr.open_array(store=str(path), mode='w', shape=array.shape, chunks=chunks,
+                            dtype=array.dtype)
+    if geometry is not None:
+        store.attrs.update({
+            'spacing': list(geometry.GetSpacing()),
+            'origin': list(geometry.GetOrigin()),
+            'direction': list(geometry.GetDirection()),
+        })
+
+    def write_slab(z0):
+        rows = slice(z0, min(z0 + chunks[0], array.shape[0]))
+        store[rows] = array[rows]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(write_slab, range(0, array.shape[0], chunks[0])))
+    return store
+
+def read_volume(path, region=None):
+    """Reads a zarr volume, or only region (a tuple of slices in (z, y, x) order).
+
+    Only the chunks overlapping the region are decompressed.
+    """
+    _require_zarr()
+    store = zarr.open_array(store=str(path), mode='r')
+    return store[...] if region is None else store[region]
+
+def read_image(path, region=None):
+    """Reads a zarr volume (or region) as a SimpleITK image with its stored geometry.
+
+    The origin is moved to the first voxel of the region.
+    """
+    _require_zarr()
+    store = zarr.open_array(store=str(path), mode='r')
+    array = store[...] if region is None else store[region]
+    image = sitk.GetImageFromArray(array, isVector=array.ndim == 4)
+    if 'spacing' not in store.attrs:
+        return image
+
+    image.SetSpacing(store.attrs['spacing'])
+    image.SetDirection(store.attrs['direction'])
+    start = [0, 0, 0]
+    if region is not None:
+        start = [s.indices(n)[0] for s, n in zip(region, store.shape[:3])] + [0] * (3 - len(region))
+    reference = sitk.Image([1, 1, 1], sitk.sitkUInt8)
+    reference.SetSpacing(store.attrs['spacing'])
+    reference.SetOrigin(store.attrs['origin'])
+    reference.SetDirection(store.attrs['direction'])
+    image.SetOrigin(reference.TransformIndexToPhysicalPoint([int(i) for i in start[::-1]]))
+    return image
+
+def write_output(image, path, workers=None):
+    """Writes image to path: as a zarr array for .zarr paths, with SimpleITK otherwise."""
+    if is_array_store(path):
+        write_volume(path, sitk.GetArrayViewFromImage(image), image, workers=workers)
+    else:
+        sitk.WriteImage(image, str(path))
+
+def write_output_atomic(image, path, workers=None):
+    """write_output through a temporary file in the same directory, renamed into place.
+
+    Readers watching the output directory never see a partially written file.
+    """
+    path = str(path).rstrip('/')
+    directory, name = os.path.split(path)
+    tmp_path = os.path.join(directory, f".tmp-{os.getpid()}-{name}")
+    write_output(image, tmp_path, workers)
+    if is_array_store(path) and os.path.isdir(path):
+        # A directory cannot replace a non-empty one; move the old store aside first
+        old_path = os.path.join(directory, f".old-{os.getpid()}-{name}")
+        os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_path)
+    else:
+        os.replace(tmp_path, path)
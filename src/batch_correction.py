@@ -0,0 +1,183 @@
+# batch_correction.py
+#
+# Cohort batch runner: corrects every (MR volume, B0 map) pair listed in a
+# manifest on a process pool. The phantom GNL field is loaded and resampled
+# once in the parent process and shared read-only with the workers through
+# shared memory.
+#
+# Manifest: a CSV file with the columns mr, b0 and output, e.g.
+#
+#     mr,b0,output
+#     data/mouse_35_MR.nii,data/B0_Map_Mouse_35.nii,results/mouse_35_b0_gnl.nii
+#
+# Outputs ending in .zarr are written as chunked, compressed zarr arrays.
+# With --roi the warp is restricted to a region of interest ('auto' or a
+# bounding box x0,y0,z0,x1,y1,z1, see roi_mask); an optional manifest column
+# roi overrides it per subject (a mask file, 'auto' or a bounding box).
+# With --store-fields DIR the resampled GNL field (DIR/gnl_field.zarr, once)
+# and the B0 shift map in mm of every subject (DIR/<output>_b0_shift_mm.zarr,
+# on the MR grid) are stored as chunked zarr arrays as well.
+#
+# Usage:
+#     python src/batch_correction.py manifest.csv --gnl-field field.nii --workers 32
+#
+# With --profile profile.jsonl every worker records per-stage timings and
+# memory of its subjects; the records are appended to profile.jsonl and the
+# stage cost distribution across the cohort is printed at the end.
+
+import argparse
+import csv
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+import SimpleITK as sitk
+
+from array_store import field_store_path, write_output_atomic, write_volume
+from B0_GNL_composed_correction import correct_subject, target_grid_image
+from gnl_field_cache import resample_phantom_field_cached
+from instrumentation import StageProfiler, append_record, format_summary, summarize_records
+from roi_mask import parse_roi
+
+# Read-only view of the shared GNL field, set in every worker by _init_worker
+_gnl_field = None
+_gnl_shm = None
+
+def read_manifest(manifest_path):
+    """Reads the (mr, b0, output) rows of a batch manifest."""
+    with open(manifest_path, newline='') as f:
+        rows = [row for row in csv.DictReader(f)]
+    for row in rows:
+        missing = {'mr', 'b0', 'output'} - set(row)
+        if missing:
+            raise ValueError(f"Manifest {manifest_path} is missing columns: {sorted(missing)}")
+    return rows
+
+def share_array(array):
+    """Copies an array into a new shared memory block."""
+    shm = shared_memory.SharedMemory(create=True, size=array.nbytes)
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared[...] = array
+    return shm
+
+def _init_worker(shm_name, shape, dtype):
+    global _gnl_field, _gnl_shm
+    # Workers run side by side, so keep SimpleITK from oversubscribing the node
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(1)
+    _gnl_shm = shared_memory.SharedMemory(name=shm_name)
+    _gnl_field = np.ndarray(shape, dtype=dtype, buffer=_gnl_shm.buf)
+    _gnl_field.flags.writeable = False
+
+def _correct_row(row, target_shape, profile=False, roi=None, store_fields=None):
+    start = time.perf_counter()
+    # Closing stops tracemalloc even if the correction fails, so the warm
+    # worker does not trace the allocations of its next subjects
+    with StageProfiler(row['mr'], enabled=profile) as profiler:
+        with profiler.stage('load'):
+            MR_Volume = sitk.ReadImage(row['mr'])
+            B0_Map = sitk.ReadImage(row['b0'])
+
+        if row.get('roi'):
+            roi = parse_roi(row['roi'])
+        report = {}
+        corrected_volume = correct_subject(
+            MR_Volume, B0_Map, _gnl_field, target_shape, profiler=profiler, roi=roi, report=report
+        )
+
+        output_dir = os.path.dirname(row['output'])
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        with profiler.stage('write'):
+            write_output_atomic(corrected_volume, row['output'], workers=1)
+            if store_fields:
+                write_volume(field_store_path(store_fields, row['output'], 'b0_shift_mm'),
+                             report['B0_Map_Array_mm'], MR_Volume, workers=1)
+    return time.perf_counter() - start, profiler.record() if profile else None
+
+def run_batch(rows, gnl_field_path, target_shape=(112, 128, 128), workers=None, profile_path=None,
+              roi=None, store_fields=None):
+    """Corrects all manifest rows on a process pool and returns a list of (row, error) failures.
+
+    With profile_path the per-stage profile record of every subject is
+    appended to that JSON lines file. roi restricts every correction to a
+    region of interest unless the row has its own. With store_fields (a
+    directory) the resampled GNL field and the B0 shift maps are written
+    there as zarr arrays.
+    """
+    if not rows:
+        raise ValueError("manifest has no rows")
+    reference = sitk.ReadImage(rows[0]['mr'])
+    Phantom_Displacement_Field_Array_Resampled = resample_phantom_field_cached(
+        gnl_field_path, reference, target_shape
+    )
+    if store_fields:
+        os.makedirs(store_fields, exist_ok=True)
+        write_volume(os.path.join(store_fields, 'gnl_field.zarr'),
+                     Phantom_Displacement_Field_Array_Resampled,
+                     target_grid_image(reference, target_shape), workers=workers)
+
+    shm = share_array(Phantom_Displacement_Field_Array_Resampled)
+    initargs = (
+        shm.name,
+        Phantom_Displacement_Field_Array_Resampled.shape,
+        Phantom_Displacement_Field_Array_Resampled.dtype,
+    )
+    del Phantom_Displacement_Field_Array_Resampled
+
+    failures = []
+    records = []
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs) as executor:
+            futures = {
+                executor.submit(_correct_row, row, target_shape, profile_path is not None, roi,
+                                store_fields): row
+                for row in rows
+            }
+            for future in as_completed(futures):
+                row = futures[future]
+                try:
+                    elapsed, record = future.result()
+                except Exception as error:
+                    failures.append((row, error))
+                    print(f"FAILED {row['mr']}: {error}")
+                else:
+                    print(f"{row['mr']} -> {row['output']} ({elapsed:.1f} s)")
+                    if record is not None:
+                        append_record(profile_path, record)
+                        records.append(record)
+    finally:
+        shm.close()
+        shm.unlink()
+    if records:
+        print(format_summary(summarize_records(records)))
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch B0+GNL distortion correction of a cohort.")
+    parser.add_argument('manifest', help="CSV file with the columns mr, b0 and output")
+    parser.add_argument('--gnl-field', required=True, help="Phantom GNL displacement field (NIfTI)")
+    parser.add_argument('--target-shape', type=int, nargs=3, default=(112, 128, 128),
+                        metavar=('Z', 'Y', 'X'), help="Upsampled grid shape (default: 112 128 128)")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument('--profile', metavar='PROFILE_JSONL',
+                        help="Append per-stage timings and memory of every subject to this file")
+    parser.add_argument('--roi', type=parse_roi,
+                        help="Region of interest: 'auto' (Otsu foreground) or x0,y0,z0,x1,y1,z1")
+    parser.add_argument('--store-fields', metavar='DIR',
+                        help="Also store the resampled GNL field and the B0 shift maps as zarr arrays in DIR")
+    args = parser.parse_args()
+
+    rows = read_manifest(args.manifest)
+    failures = run_batch(
+        rows, args.gnl_field, tuple(args.target_shape), args.workers, args.profile, args.roi,
+        args.store_fields
+    )
+    print(f"Corrected {len(rows) - len(failures)} of {len(rows)} subjects")
+    if failures:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+# dtype_policy.py
+#
+# Floating point type of the array stages of the pipeline (loading, zooming,
+# field building, warping and writing). Sub-voxel shifts at 15.2T do not need
+# double precision, so float32 is the default; set
+# DISTORTION_CORRECTION_DTYPE=float64 to run the whole pipeline in double
+# precision. Spline prefilter coefficients stay float64 internally, as in scipy.
+
+import os
+
+import numpy as np
+
+DEFAULT_DTYPE = np.dtype(os.environ.get('DISTORTION_CORRECTION_DTYPE', 'float32'))
+
+def as_working_dtype(array, dtype=DEFAULT_DTYPE):
+    """Returns array in the working floating point type, without copying if it already is."""
+    return np.asarray(array).astype(dtype, copy=False)
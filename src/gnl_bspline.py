@@ -0,0 +1,155 @@
+# gnl_bspline.py
+#
+# Compact representation of the phantom GNL displacement field as cubic
+# B-spline coefficients on a coarse control-point grid. The gradient
+# non-linearity is smooth, so a control point every few phantom voxels
+# reproduces the dense field to a small fraction of a voxel while the stored
+# file shrinks by orders of magnitude. The field is fitted once per phantom
+# calibration and then evaluated on demand, slab by slab, on any target grid;
+# no per-geometry zoom or cache entry is needed.
+#
+# Like resample_phantom_field (scipy.ndimage.zoom), the corner voxels of the
+# phantom grid are mapped onto the corner voxels of the target grid, and the
+# displacements stay in voxel units.
+#
+# Usage:
+#     python src/gnl_bspline.py Cropped_Displacement_Field_Mouse_Dimensions.nii --control-spacing 8 --output gnl_bspline.npz
+#
+# The .npz file can then be given wherever a phantom field path is expected
+# (--gnl-field of the batch, session, watch-folder, Jacobian and point tools).
+
+import argparse
+import os
+
+import numpy as np
+import SimpleITK as sitk
+
+from dtype_policy import DEFAULT_DTYPE
+
+def is_bspline_field(path):
+    """True for B-spline coefficient files written by save_bspline_field."""
+    return str(path).endswith('.npz')
+
+def cubic_bspline(x):
+    """Uniform cubic B-spline kernel."""
+    x = np.abs(x)
+    return np.where(
+        x < 1, 2.0 / 3.0 - x ** 2 + 0.5 * x ** 3,
+        np.where(x < 2, (2.0 - x) ** 3 / 6.0, 0.0)
+    )
+
+def bspline_basis(n, m):
+    """(n, m) matrix of the m control-point basis functions at n grid positions.
+
+    The first and last grid positions fall on control points 1 and m - 2, so
+    one control point on either side only supports the border.
+    """
+    if n > 1:
+        t = 1.0 + np.arange(n) * (m - 3) / (n - 1)
+    else:
+        t = np.array([1.0 + (m - 3) / 2.0])
+    return cubic_bspline(t[:, None] - np.arange(m)[None, :])
+
+def fit_bspline_field(Phantom_Displacement_Field_Array, control_spacing=8):
+    """Least-squares fit of the (z, y, x, 3) phantom field on a control grid.
+
+    control_spacing is the distance of the control points in phantom voxels.
+    The tensor-product basis is separable, so the least-squares coefficients
+    follow from one pseudo-inverse per axis.
+    """
+    coefficients = np.asarray(Phantom_Displacement_Field_Array, dtype=np.float64)
+    for axis, n in enumerate(coefficients.shape[:3]):
+        m = int(np.ceil((n - 1) / control_spacing)) + 3
+        pinv = np.linalg.pinv(bspline_basis(n, m))
+        coefficients = np.moveaxis(np.tensordot(pinv, coefficients, axes=(1, axis)), 0, axis)
+    return coefficients
+
+class BSplineField:
+    """Phantom GNL field on a target grid, evaluated from B-spline coefficients on demand.
+
+    Behaves like the (z, y, x, 3) array returned by resample_phantom_field:
+    indexing evaluates only the requested rows of the first axis, so the warp
+    engines can read it slab by slab; np.asarray evaluates the whole field.
+    """
+
+    def __init__(self, coefficients, target_shape, dtype=DEFAULT_DTYPE):
+        self.coefficients = coefficients
+        self.shape = tuple(int(n) for n in target_shape) + (3,)
+        self.dtype = np.dtype(dtype)
+        self.ndim = 4
+        self.itemsize = self.dtype.itemsize
+        self.nbytes = int(np.prod(self.shape)) * self.itemsize
+        self._basis = [bspline_basis(n, m) for n, m in zip(self.shape[:3], coefficients.shape[:3])]
+
+    def resampled(self, target_shape):
+        """The same field on another target grid."""
+        return BSplineField(self.coefficients, target_shape, self.dtype)
+
+    def rows(self, rows=slice(None)):
+        """Evaluates the field for a slice of the first array axis."""
+        basis_z, basis_y, basis_x = self._basis
+        field = np.tensordot(basis_z[rows], self.coefficients, axes=(1, 0))
+        field = np.tensordot(field, basis_y, axes=(1, 1))
+        field = np.tensordot(field, basis_x, axes=(1, 1))
+        # (z, 3, y, x) -> (z, y, x, 3)
+        return np.ascontiguousarray(np.moveaxis(field, 1, -1), dtype=self.dtype)
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        first, rest = key[0], key[1:]
+        if isinstance(first, slice):
+            return self.rows(first)[(slice(None),) + rest]
+        if isinstance(first, (int, np.integer)):
+            index = range(self.shape[0])[first]
+            return self.rows(slice(index, index + 1))[(0,) + rest]
+        return self.rows()[key]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        field = self.rows()
+        return field if dtype is None else field.astype(dtype, copy=False)
+
+def save_bspline_field(path, coefficients, source_shape, control_spacing):
+    """Writes the coefficients with the phantom grid they were fitted on."""
+    np.savez(path, coefficients=coefficients, source_shape=np.asarray(source_shape),
+             control_spacing=control_spacing)
+
+def load_bspline_field(path, target_shape, dtype=DEFAULT_DTYPE):
+    """Returns the BSplineField of a coefficient file on target_shape."""
+    with np.load(path) as data:
+        coefficients = data['coefficients']
+    return BSplineField(coefficients, target_shape, dtype)
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit the phantom GNL field with B-spline control points.")
+    parser.add_argument('field', help="Phantom GNL displacement field (NIfTI)")
+    parser.add_argument('--control-spacing', type=float, default=8,
+                        help="Distance of the control points in phantom voxels (default: 8)")
+    parser.add_argument('--output', required=True, help="Output coefficient file (.npz)")
+    args = parser.parse_args()
+
+    # 1. Load the dense phantom field
+    Phantom_Displacement_Field_Array = sitk.GetArrayFromImage(sitk.ReadImage(args.field))
+    source_shape = Phantom_Displacement_Field_Array.shape[:3]
+
+    # 2. Fit the control-point coefficients
+    coefficients = fit_bspline_field(Phantom_Displacement_Field_Array, args.control_spacing)
+
+    # 3. Fit error on the phantom grid, in voxels
+    fitted = BSplineField(coefficients, source_shape, np.float64)
+    error = np.zeros(source_shape)
+    for z0 in range(0, source_shape[0], 16):
+        rows = slice(z0, z0 + 16)
+        difference = fitted[rows] - Phantom_Displacement_Field_Array[rows]
+        error[rows] = np.sqrt(np.einsum('...i,...i->...', difference, difference))
+
+    # 4. Save
+    save_bspline_field(args.output, coefficients, source_shape, args.control_spacing)
+    print(f"{source_shape} -> {coefficients.shape[:3]} control points "
+          f"({os.path.getsize(args.field) / os.path.getsize(args.output):.0f}x smaller), "
+          f"fit error rms {np.sqrt(np.mean(error ** 2)):.4f} max {error.max():.4f} voxels")
+
+if __name__ == "__main__":
+    main()
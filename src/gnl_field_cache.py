@@ -0,0 +1,149 @@
+# gnl_field_cache.py
+#
+# Persistent on-disk cache of the phantom GNL displacement field resampled to
+# a target grid. GNL is sequence- and subject-independent, so the resampled
+# field only depends on the phantom field itself and the target geometry.
+# Entries are plain .npy files that are returned memory-mapped; the least
+# recently used entries are evicted once the cache exceeds its size limit.
+# resample_phantom_field does the uncached resampling.
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+import SimpleITK as sitk
+import scipy.ndimage
+
+from dtype_policy import DEFAULT_DTYPE
+from gnl_bspline import BSplineField, is_bspline_field, load_bspline_field
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    'GNL_FIELD_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'distortion_correction', 'gnl_fields')
+)
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+def resample_phantom_field(Phantom_Displacement_Field_Array, target_shape, dtype=DEFAULT_DTYPE,
+                           output=None):
+    """Resamples each component of the phantom displacement field to target_shape.
+
+    output may be a preallocated (e.g. memory-mapped) target_shape + (3,)
+    array; each component is zoomed straight into it. A BSplineField
+    (gnl_bspline) is evaluated on target_shape instead of zoomed.
+    """
+    if isinstance(Phantom_Displacement_Field_Array, BSplineField):
+        field = Phantom_Displacement_Field_Array.resampled(target_shape)
+        if output is None:
+            return field.rows()
+        for z0 in range(0, field.shape[0], 16):
+            output[z0:z0 + 16] = field[z0:z0 + 16]
+        return output
+
+    zoom_factors = tuple(
+        t / s for t, s in zip(target_shape, Phantom_Displacement_Field_Array.shape[:3])
+    )
+
+    if output is None:
+        output = np.zeros(tuple(target_shape) + (3,), dtype=dtype)
+    for i in range(3):
+        scipy.ndimage.zoom(
+            Phantom_Displacement_Field_Array[..., i],
+            zoom_factors,
+            output=output[..., i],
+            order=3
+        )
+    return output
+
+def field_content_hash(field_path, block_size=1 << 20):
+    """Returns the SHA-256 digest of the phantom field file."""
+    digest = hashlib.sha256()
+    with open(field_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def cache_key(content_hash, target_shape, spacing, origin, direction, dtype=DEFAULT_DTYPE):
+    """Builds the cache key from the field hash, the target grid geometry and the dtype."""
+    geometry = {
+        'field': content_hash,
+        'dtype': np.dtype(dtype).str,
+        'shape': [int(n) for n in target_shape],
+        'spacing': [round(float(v), 9) for v in spacing],
+        'origin': [round(float(v), 9) for v in origin],
+        'direction': [round(float(v), 9) for v in direction],
+    }
+    return hashlib.sha256(json.dumps(geometry, sort_keys=True).encode()).hexdigest()
+
+def evict_lru(cache_dir, max_bytes, keep=()):
+    """Removes the least recently used entries until the cache fits in max_bytes."""
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.npy'):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path in keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def resample_phantom_field_cached(field_path, image, target_shape=None,
+                                  cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES,
+                                  dtype=DEFAULT_DTYPE):
+    """Returns the phantom field resampled to the grid of image, memory-mapped from the cache.
+
+    target_shape defaults to the array shape of image; the spacing, origin and
+    direction of image complete the cache key. Only the geometry of image is
+    used, so the output of nifti_mmap.read_image_information works as well.
+    B-spline coefficient files (gnl_bspline) are not cached: the returned
+    BSplineField evaluates the field on demand.
+    """
+    if target_shape is None:
+        target_shape = image.GetSize()[::-1]
+    if is_bspline_field(field_path):
+        return load_bspline_field(field_path, target_shape, dtype)
+    key = cache_key(
+        field_content_hash(field_path), target_shape,
+        image.GetSpacing(), image.GetOrigin(), image.GetDirection(), dtype
+    )
+    os.makedirs(cache_dir, exist_ok=True)
+    entry_path = os.path.join(cache_dir, key + '.npy')
+
+    if os.path.exists(entry_path):
+        # Mark the entry as recently used
+        os.utime(entry_path)
+        return np.load(entry_path, mmap_mode='r')
+
+    Phantom_Displacement_Field = sitk.ReadImage(field_path)
+
+    # Resample straight into a memory-mapped temporary file, so the field at the
+    # target resolution never has to fit in memory, and so concurrent readers
+    # never see a partial entry
+    fd, tmp_path = tempfile.mkstemp(suffix='.npy.tmp', dir=cache_dir)
+    os.close(fd)
+    output = np.lib.format.open_memmap(
+        tmp_path, mode='w+', dtype=dtype, shape=tuple(int(n) for n in target_shape) + (3,)
+    )
+    resample_phantom_field(
+        sitk.GetArrayFromImage(Phantom_Displacement_Field), target_shape, dtype, output=output
+    )
+    output.flush()
+    del output
+    os.replace(tmp_path, entry_path)
+
+    evict_lru(cache_dir, max_bytes, keep=(entry_path,))
+    return np.load(entry_path, mmap_mode='r')
@@ -0,0 +1,209 @@
+# instrumentation.py
+#
+# Per-stage profiling of the correction scripts. A StageProfiler records wall
+# time, CPU time, peak RSS and the largest array allocations of every named
+# stage and emits one JSON record per subject. Set
+# DISTORTION_CORRECTION_PROFILE=profile.jsonl to enable it in the scripts;
+# when disabled, stage() returns a shared no-op context manager.
+#
+# Usage (cohort summary of the collected records):
+#     python src/instrumentation.py profile.jsonl
+
+import argparse
+import contextlib
+import json
+import os
+import socket
+import time
+import tracemalloc
+
+import numpy as np
+
+PROFILE_PATH = os.environ.get('DISTORTION_CORRECTION_PROFILE')
+
+_NULL_STAGE = contextlib.nullcontext()
+
+# Allocations below this size are not reported as large allocations
+MIN_ALLOCATION_BYTES = 1024 ** 2
+
+_OWN_FRAMES = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+)
+
+def peak_rss_bytes():
+    """Peak resident set size of this process (since the last reset_peak_rss)."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # resource is not available on Windows; ru_maxrss is in kB on Linux and in bytes on macOS
+    import resource
+    scale = 1 if os.uname().sysname == 'Darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+def reset_peak_rss():
+    """Resets the peak RSS high-water mark where the kernel allows it (Linux)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+class StageProfiler:
+    """Collects per-stage wall time, CPU time, peak RSS and largest allocations of one subject.
+
+    Allocation tracking uses tracemalloc, which numpy reports its array
+    buffers to; it slows allocations down, so it can be switched off with
+    track_allocations=False. SimpleITK buffers only show up in the RSS. Used
+    as a context manager it is closed on exit, also when a stage raises.
+    """
+
+    def __init__(self, subject, enabled=True, track_allocations=True, top_allocations=5):
+        self.subject = subject
+        self.enabled = enabled
+        self.track_allocations = enabled and track_allocations
+        self.top_allocations = top_allocations
+        self.stages = []
+        self._started_tracing = False
+
+    def stage(self, name):
+        """Context manager that profiles the enclosed block as stage name."""
+        if not self.enabled:
+            return _NULL_STAGE
+        return self._profile_stage(name)
+
+    @contextlib.contextmanager
+    def _profile_stage(self, name):
+        if self.track_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        if self.track_allocations:
+            tracemalloc.reset_peak()
+            snapshot_start = tracemalloc.take_snapshot()
+        peak_resettable = reset_peak_rss()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            record = {
+                'stage': name,
+                'wall_seconds': time.perf_counter() - wall_start,
+                'cpu_seconds': time.process_time() - cpu_start,
+                'peak_rss_bytes': peak_rss_bytes(),
+                # Without a reset the peak RSS is the process-wide high-water mark
+                'peak_rss_is_stage_peak': peak_resettable,
+            }
+            if self.track_allocations:
+                record['traced_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+                # Arrays allocated in the stage and still alive at its end; transient
+                # arrays only show up in traced_peak_bytes
+                growth = tracemalloc.take_snapshot().filter_traces(_OWN_FRAMES).compare_to(
+                    snapshot_start.filter_traces(_OWN_FRAMES), 'lineno'
+                )
+                record['largest_allocations'] = [
+                    {'location': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                     'bytes': stat.size_diff}
+                    for stat in sorted(growth, key=lambda s: s.size_diff, reverse=True)[:self.top_allocations]
+                    if stat.size_diff >= MIN_ALLOCATION_BYTES
+                ]
+            self.stages.append(record)
+
+    def record(self):
+        """Returns the JSON-serialisable profile record of the subject."""
+        return {
+            'subject': self.subject,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'wall_seconds': sum(stage['wall_seconds'] for stage in self.stages),
+            'peak_rss_bytes': peak_rss_bytes(),
+            'stages': self.stages,
+        }
+
+    def write(self, path=None):
+        """Appends the record as one JSON line to path (default: DISTORTION_CORRECTION_PROFILE)."""
+        path = path or PROFILE_PATH
+        if not self.enabled or path is None:
+            return
+        self.close()
+        append_record(path, self.record())
+
+    def close(self):
+        """Stops tracemalloc if this profiler started it."""
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# Disabled profiler used as the default of functions that accept a profiler
+NULL_PROFILER = StageProfiler(None, enabled=False)
+
+def profiler_for(subject, path=None):
+    """Returns a StageProfiler that is enabled when a profile path is configured."""
+    return StageProfiler(subject, enabled=(path or PROFILE_PATH) is not None)
+
+def append_record(path, record):
+    """Appends one record to a JSON lines file in a single write."""
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+def read_records(path):
+    """Reads the records of a JSON lines profile file."""
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def summarize_records(records):
+    """Distribution of the wall time, CPU time and peak RSS of every stage across subjects.
+
+    Returns {stage: {'subjects': n, '<metric>': {'median': ..., 'p90': ..., 'max': ...}}}.
+    """
+    values = {}
+    for record in records:
+        for stage in record['stages']:
+            entry = values.setdefault(stage['stage'], {'wall_seconds': [], 'cpu_seconds': [], 'peak_rss_bytes': []})
+            for metric, samples in entry.items():
+                samples.append(stage[metric])
+
+    summary = {}
+    for name, metrics in values.items():
+        summary[name] = {'subjects': len(metrics['wall_seconds'])}
+        for metric, samples in metrics.items():
+            summary[name][metric] = {
+                'median': float(np.median(samples)),
+                'p90': float(np.percentile(samples, 90)),
+                'max': float(np.max(samples)),
+            }
+    return summary
+
+def format_summary(summary):
+    """Formats the output of summarize_records as a text table."""
+    lines = [f"{'stage':<28s} {'n':>4s} {'wall med':>9s} {'wall p90':>9s} {'wall max':>9s} "
+             f"{'cpu med':>9s} {'RSS max':>9s}"]
+    total = sum(stats['wall_seconds']['median'] for stats in summary.values()) or 1.0
+    for name, stats in sorted(summary.items(), key=lambda item: -item[1]['wall_seconds']['median']):
+        lines.append(
+            f"{name:<28s} {stats['subjects']:4d} {stats['wall_seconds']['median']:8.2f}s "
+            f"{stats['wall_seconds']['p90']:8.2f}s {stats['wall_seconds']['max']:8.2f}s "
+            f"{stats['cpu_seconds']['median']:8.2f}s {stats['peak_rss_bytes']['max'] / 1024 ** 2:7.0f}MB"
+            f"  ({100 * stats['wall_seconds']['median'] / total:.0f}%)"
+        )
+    return '\n'.join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize per-stage profile records across a cohort.")
+    parser.add_argument('profile', help="JSON lines file written with DISTORTION_CORRECTION_PROFILE")
+    args = parser.parse_args()
+    print(format_summary(summarize_records(read_records(args.profile))))
+
+if __name__ == "__main__":
+    main()
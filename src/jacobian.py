@@ -0,0 +1,213 @@
+# jacobian.py
+#
+# Jacobian determinant of the ΔB0, GNL and composed ΔB0+GNL corrections,
+# computed from the sampling coordinates with vectorised finite differences
+# (np.gradient: central differences inside, one-sided at the border). The
+# coordinates are generated slab by slab with a one-row halo, so the result is
+# identical to a whole-volume computation while memory stays flat, and the
+# histogram and summary statistics are accumulated in the same streaming pass.
+#
+# All three maps are evaluated on the target grid of the correction, with
+# the sampling coordinates of fused_coordinates (the mapping the corrected
+# volumes are written with) expressed in target-grid voxels, so a
+# determinant of 1 means the correction preserves the local volume.
+#
+# Usage:
+#     python src/jacobian.py MR.nii B0_Map.nii --gnl-field field.nii --output-prefix results/mouse_35
+
+import argparse
+import json
+
+import numpy as np
+import SimpleITK as sitk
+
+from B0_correction import formula, register_b0_map
+from B0_GNL_composed_correction import fused_coordinates, target_grid_image
+from dtype_policy import DEFAULT_DTYPE
+from gnl_field_cache import resample_phantom_field_cached
+from nifti_mmap import create_nifti_memmap
+
+def composed_coordinates(B0_Map_Array_mm, gnl_field_resampled, target_image, dtype=DEFAULT_DTYPE):
+    """Coordinate function rows -> (3, ...) fused ΔB0+GNL sampling coordinates in target-grid voxels.
+
+    B0_Map_Array_mm is the B0 shift in mm on the MR grid and
+    gnl_field_resampled the phantom field on the target grid, as for
+    fused_coordinates, whose coordinates are divided by its MR-grid scaling.
+    """
+    dtype = np.dtype(dtype)
+    target_shape = target_image.GetSize()[::-1]
+    scale = np.array([
+        (n_in - 1) / (n_out - 1) if n_out > 1 else 1.0
+        for n_in, n_out in zip(B0_Map_Array_mm.shape, target_shape)
+    ], dtype=dtype).reshape(3, 1, 1, 1)
+
+    def coordinates(rows):
+        return fused_coordinates(B0_Map_Array_mm, gnl_field_resampled, target_image, rows, dtype) / scale
+    return coordinates
+
+def b0_coordinates(B0_Map_Array_mm, target_image, dtype=DEFAULT_DTYPE):
+    """Coordinate function of the ΔB0 correction alone on the target grid."""
+    # A broadcast zero field costs no memory
+    no_gnl = np.broadcast_to(np.zeros(1, dtype=dtype), tuple(target_image.GetSize()[::-1]) + (3,))
+    return composed_coordinates(B0_Map_Array_mm, no_gnl, target_image, dtype)
+
+def gnl_coordinates(B0_Map_Array_mm, gnl_field_resampled, target_image, dtype=DEFAULT_DTYPE):
+    """Coordinate function of the GNL correction alone on the target grid (field in target voxels)."""
+    no_b0 = np.zeros(B0_Map_Array_mm.shape, dtype=dtype)
+    return composed_coordinates(no_b0, gnl_field_resampled, target_image, dtype)
+
+def determinant_3x3(jacobian):
+    """Element-wise determinant of a (3, 3, ...) stack of matrices."""
+    (a, b, c), (d, e, f), (g, h, i) = jacobian
+    return a * (e * i - f * h) - b * (d * i - f * g) + c * (d * h - e * g)
+
+def jacobian_determinant_slabs(coordinates, shape, slab=16):
+    """Yields (rows, determinant) for consecutive slabs of the first array axis.
+
+    coordinates(rows) returns the (3,) + slab shape sampling coordinates in
+    index units. Each slab is computed with one halo row on either side, so
+    the finite differences match np.gradient of the whole volume exactly.
+    """
+    n = shape[0]
+    for z0 in range(0, n, slab):
+        z1 = min(z0 + slab, n)
+        lo, hi = max(z0 - 1, 0), min(z1 + 1, n)
+        block = coordinates(slice(lo, hi))
+        jacobian = [np.gradient(component, axis=(0, 1, 2)) for component in block]
+        yield slice(z0, z1), determinant_3x3(jacobian)[z0 - lo:z1 - lo]
+
+class StreamingHistogram:
+    """Fixed-bin histogram with count, mean, standard deviation, extrema and folding fraction.
+
+    Values below or above the bin range are counted in under- and overflow
+    counters. Quantiles are interpolated within the histogram bins. edges
+    (e.g. logarithmically spaced) overrides bins and range.
+    """
+
+    def __init__(self, bins=200, range=(0.0, 2.0), edges=None):
+        self.edges = np.linspace(range[0], range[1], bins + 1) if edges is None else np.asarray(edges)
+        self.counts = np.zeros(self.edges.size - 1, dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+        self.count = 0
+        self.folded = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+
+    def update(self, values):
+        values = np.asarray(values).reshape(-1)
+        values = values[np.isfinite(values)]
+        if values.size == 0:
+            return
+        # Running moments, merged per chunk (Chan et al.) to stay stable in one pass
+        values64 = values.astype(np.float64)
+        chunk_mean = float(values64.mean())
+        chunk_m2 = float(np.dot(values64 - chunk_mean, values64 - chunk_mean))
+        total = self.count + values.size
+        delta = chunk_mean - self.mean
+        self.mean += delta * values.size / total
+        self._m2 += chunk_m2 + delta * delta * self.count * values.size / total
+        self.count = total
+        self.minimum = min(self.minimum, float(values.min()))
+        self.maximum = max(self.maximum, float(values.max()))
+        # A non-positive determinant means the mapping folds over
+        self.folded += int(np.count_nonzero(values <= 0))
+        self.underflow += int(np.count_nonzero(values < self.edges[0]))
+        self.overflow += int(np.count_nonzero(values > self.edges[-1]))
+        self.counts += np.histogram(values, self.edges)[0]
+
+    def quantile(self, q):
+        """Approximate q-quantile (0 <= q <= 1) interpolated within the histogram bins."""
+        target = q * self.count
+        cumulative = self.underflow + np.cumsum(self.counts)
+        if target <= self.underflow:
+            return self.minimum if self.underflow else float(self.edges[0])
+        if target > cumulative[-1]:
+            return self.maximum
+        b = int(np.searchsorted(cumulative, target))
+        below = cumulative[b] - self.counts[b]
+        fraction = (target - below) / self.counts[b] if self.counts[b] else 0.0
+        return float(self.edges[b] + fraction * (self.edges[b + 1] - self.edges[b]))
+
+    def summary(self):
+        variance = self._m2 / self.count if self.count else float('nan')
+        return {
+            'count': self.count,
+            'mean': self.mean if self.count else float('nan'),
+            'std': float(np.sqrt(variance)),
+            'var': variance,
+            'min': self.minimum,
+            'max': self.maximum,
+            'p05': self.quantile(0.05),
+            'median': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'folded_fraction': self.folded / self.count if self.count else float('nan'),
+        }
+
+def jacobian_statistics(coordinates, shape, output=None, mask=None, slab=16, bins=200,
+                        range=(0.0, 2.0)):
+    """Streams the Jacobian determinant once and returns its StreamingHistogram.
+
+    output may be a preallocated (e.g. memory-mapped) array of shape that
+    receives the determinant map; mask restricts the statistics to nonzero
+    voxels.
+    """
+    histogram = StreamingHistogram(bins, range)
+    for rows, determinant in jacobian_determinant_slabs(coordinates, shape, slab):
+        if output is not None:
+            output[rows] = determinant
+        histogram.update(determinant if mask is None else determinant[mask[rows] != 0])
+    return histogram
+
+def main():
+    parser = argparse.ArgumentParser(description="Jacobian determinant of the ΔB0, GNL and composed corrections.")
+    parser.add_argument('mr', help="Acquired MR volume")
+    parser.add_argument('b0_map', help="Static field map of the same subject")
+    parser.add_argument('--gnl-field', required=True, help="Phantom GNL displacement field (NIfTI)")
+    parser.add_argument('--target-shape', type=int, nargs=3, default=(112, 128, 128),
+                        metavar=('Z', 'Y', 'X'), help="Target grid of the correction (default: 112 128 128)")
+    parser.add_argument('--output-prefix',
+                        help="Write <prefix>_{b0,gnl,composed}_jacobian.nii maps and <prefix>_jacobian.json")
+    parser.add_argument('--slab', type=int, default=16, help="Rows per slab (default: 16)")
+    parser.add_argument('--bins', type=int, default=200, help="Histogram bins over --range")
+    parser.add_argument('--range', type=float, nargs=2, default=(0.0, 2.0), metavar=('LOW', 'HIGH'))
+    args = parser.parse_args()
+
+    MR_Volume = sitk.ReadImage(args.mr)
+    B0_Map = sitk.ReadImage(args.b0_map)
+    shape = tuple(args.target_shape)
+    target_image = target_grid_image(MR_Volume, shape)
+
+    final_transform, B0_Map_Resampled = register_b0_map(MR_Volume, B0_Map)
+    B0_Map_Array_mm = formula(sitk.GetArrayFromImage(B0_Map_Resampled).astype(DEFAULT_DTYPE))
+    gnl_field_resampled = resample_phantom_field_cached(args.gnl_field, MR_Volume, shape)
+
+    fields = {
+        'b0': b0_coordinates(B0_Map_Array_mm, target_image),
+        'gnl': gnl_coordinates(B0_Map_Array_mm, gnl_field_resampled, target_image),
+        'composed': composed_coordinates(B0_Map_Array_mm, gnl_field_resampled, target_image),
+    }
+    results = {}
+    for name, coordinates in fields.items():
+        output = None
+        if args.output_prefix:
+            output = create_nifti_memmap(f"{args.output_prefix}_{name}_jacobian.nii", target_image, np.float32)
+        histogram = jacobian_statistics(coordinates, shape, output, slab=args.slab,
+                                        bins=args.bins, range=tuple(args.range))
+        if output is not None:
+            output.flush()
+            del output
+        results[name] = dict(histogram.summary(), histogram=histogram.counts.tolist(),
+                             edges=histogram.edges.tolist())
+        stats = results[name]
+        print(f"{name:<9s} mean {stats['mean']:.4f}  std {stats['std']:.4f}  "
+              f"min {stats['min']:.4f}  max {stats['max']:.4f}  folded {100 * stats['folded_fraction']:.3f}%")
+
+    if args.output_prefix:
+        with open(f"{args.output_prefix}_jacobian.json", 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
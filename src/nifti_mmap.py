@@ -0,0 +1,89 @@
+# nifti_mmap.py
+#
+# Memory-mapped NIfTI input and output for volumes larger than RAM. NIfTI
+# stores voxels with x varying fastest, which is exactly the C-order layout of
+# a (z, y, x) array, so an uncompressed .nii volume can be used as a zero-copy
+# numpy memory map. Outputs are preallocated on disk and filled slab by slab.
+
+import numpy as np
+import nibabel as nib
+import SimpleITK as sitk
+
+# SimpleITK geometry is LPS, NIfTI affines are RAS
+_LPS_TO_RAS = np.diag([-1.0, -1.0, 1.0])
+
+def is_uncompressed_nifti(path):
+    """True for single-file .nii volumes, which can be memory-mapped."""
+    return str(path).endswith('.nii')
+
+def read_nifti_memmap(path):
+    """Returns an uncompressed scalar 3-D .nii volume as a read-only (z, y, x) memory map.
+
+    Raises ValueError if the file cannot be mapped without copying (gzip,
+    intensity scaling, more than three dimensions).
+    """
+    if not is_uncompressed_nifti(path):
+        raise ValueError(f"{path} is not an uncompressed .nii file")
+    nifti = nib.load(path, mmap='r')
+    if nifti.ndim != 3:
+        raise ValueError(f"{path} is not a scalar 3-D volume")
+    slope, inter = nifti.dataobj.slope, nifti.dataobj.inter
+    if (slope, inter) != (1.0, 0.0):
+        raise ValueError(f"{path} uses intensity scaling and cannot be memory-mapped")
+    # (x, y, z) Fortran-order map -> C-contiguous (z, y, x) view of the same buffer
+    return np.asanyarray(nifti.dataobj).T
+
+def read_image_information(path):
+    """Returns a reader carrying the size, spacing, origin and direction of an image file.
+
+    The reader can stand in for an image wherever only its geometry is used
+    (GetSize, GetSpacing, GetOrigin, GetDirection); no voxels are read.
+    """
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(path))
+    reader.ReadImageInformation()
+    return reader
+
+def geometry_affine(geometry):
+    """NIfTI (RAS) affine of a SimpleITK image or of read_image_information output."""
+    direction = np.array(geometry.GetDirection()).reshape(3, 3)
+    affine = np.eye(4)
+    affine[:3, :3] = _LPS_TO_RAS @ direction @ np.diag(geometry.GetSpacing())
+    affine[:3, 3] = _LPS_TO_RAS @ np.array(geometry.GetOrigin())
+    return affine
+
+def create_nifti_memmap(path, geometry, dtype=np.float32, shape=None, time_origin=0.0, time_spacing=1.0):
+    """Preallocates a .nii file and returns its voxels as a writable (z, y, x) memory map.
+
+    geometry provides the 3-D spacing, origin and direction (an image or
+    read_image_information output); shape defaults to its size. A 4-D
+    (t, z, y, x) shape gives a series with the time_origin and time_spacing
+    of its frames. The file is created sparse, so disk blocks are only
+    allocated when slabs are written.
+    """
+    if shape is None:
+        shape = geometry.GetSize()[::-1]
+    shape = tuple(int(n) for n in shape)
+    dtype = np.dtype(dtype)
+
+    header = nib.Nifti1Header()
+    header.set_data_dtype(dtype)
+    header.set_data_shape(shape[::-1])
+    affine = geometry_affine(geometry)
+    header.set_qform(affine, code='scanner')
+    header.set_sform(affine, code='scanner')
+    if len(shape) == 4:
+        header.set_zooms(tuple(geometry.GetSpacing()[:3]) + (time_spacing,))
+        header['toffset'] = time_origin
+        header.set_xyzt_units('mm', 'sec')
+    else:
+        header.set_zooms(geometry.GetSpacing())
+        header.set_xyzt_units('mm')
+    offset = header.single_vox_offset
+    header.set_data_offset(offset)
+
+    with open(path, 'wb') as f:
+        header.write_to(f)
+        f.seek(offset + dtype.itemsize * int(np.prod(shape)) - 1)
+        f.write(b'\0')
+    return np.memmap(path, dtype=header.get_data_dtype(), mode='r+', offset=offset, shape=shape)
@@ -0,0 +1,157 @@
+# overlap_metrics.py
+#
+# Multi-label overlap metrics for segmentation QA across a cohort. Label maps
+# are read in their native integer dtype, and the full label confusion matrix
+# of a (reference, test) pair is accumulated with one bincount per slab, from
+# which Dice, Jaccard and volume differences of every label follow. Pairs are
+# evaluated on a process pool and written to a single CSV table.
+#
+# Pairs file: a CSV file with the columns subject, variant, reference and
+# test, e.g.
+#
+#     subject,variant,reference,test
+#     mouse_35,b0_gnl,seg/mouse_35_CT-label.nii,seg/mouse_35_b0_gnl-label.nii
+#     mouse_35,uncorrected,seg/mouse_35_CT-label.nii,seg/mouse_35_mr-label.nii
+#
+# Usage:
+#     python src/overlap_metrics.py pairs.csv --output overlap.csv --workers 8
+
+import argparse
+import csv
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import SimpleITK as sitk
+
+COLUMNS = [
+    'subject', 'variant', 'label', 'reference_voxels', 'test_voxels', 'intersection_voxels',
+    'dice', 'jaccard', 'volume_difference_mm3', 'relative_volume_difference',
+]
+
+def load_labels(path):
+    """Reads a label map as an integer array, keeping its stored integer dtype."""
+    labels = sitk.GetArrayFromImage(sitk.ReadImage(path))
+    if not np.issubdtype(labels.dtype, np.integer):
+        # Some tools store label maps as floating point
+        rounded = np.rint(labels)
+        if not np.array_equal(rounded, labels):
+            raise ValueError(f"{path} is not a label map (non-integer values)")
+        labels = rounded.astype(np.int32)
+    return labels
+
+def voxel_volume(path):
+    """Volume of one voxel in mm^3, from the image header."""
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    return float(np.prod(reader.GetSpacing()))
+
+def _slab_pairs(reference, test, max_span=1024):
+    """Returns (reference labels, test labels, voxels) of the label pairs present in one slab."""
+    reference = reference.astype(np.int64).ravel()
+    test = test.astype(np.int64).ravel()
+    lo = min(int(reference.min()), int(test.min()))
+    span = max(int(reference.max()), int(test.max())) - lo + 1
+    if span <= max_span:
+        # Labels offset by the slab minimum index the pair counts directly
+        counts = np.bincount((reference - lo) * span + (test - lo), minlength=span * span)
+        present = np.flatnonzero(counts)
+        return present // span + lo, present % span + lo, counts[present]
+    # Sparse labels: index them by the labels present in this slab only
+    reference_labels, reference_index = np.unique(reference, return_inverse=True)
+    test_labels, test_index = np.unique(test, return_inverse=True)
+    size = test_labels.size
+    counts = np.bincount(reference_index * size + test_index)
+    present = np.flatnonzero(counts)
+    return reference_labels[present // size], test_labels[present % size], counts[present]
+
+def confusion_matrix(reference, test, slab=16):
+    """Returns (labels, matrix) with matrix[i, j] = voxels labelled labels[i] in reference and labels[j] in test.
+
+    The maps are read once: each slab contributes the counts of the label
+    pairs present in it, and labels lists only the labels that occur.
+    """
+    if reference.shape != test.shape:
+        raise ValueError(f"Label maps differ in shape: {reference.shape} vs {test.shape}")
+    pairs = [
+        _slab_pairs(reference[z0:z0 + slab], test[z0:z0 + slab])
+        for z0 in range(0, reference.shape[0], slab)
+    ]
+    reference_labels, test_labels, counts = (np.concatenate(column) for column in zip(*pairs))
+    labels = np.union1d(reference_labels, test_labels)
+
+    matrix = np.zeros((labels.size, labels.size), dtype=np.int64)
+    np.add.at(matrix, (np.searchsorted(labels, reference_labels), np.searchsorted(labels, test_labels)), counts)
+    return labels, matrix
+
+def overlap_table(labels, matrix, voxel_mm3=1.0, background=0):
+    """Per-label Dice, Jaccard and volume differences from a confusion matrix."""
+    reference_voxels = matrix.sum(axis=1)
+    test_voxels = matrix.sum(axis=0)
+    intersection = np.diag(matrix)
+    rows = []
+    for k, label in enumerate(labels):
+        if label == background:
+            continue
+        union = reference_voxels[k] + test_voxels[k] - intersection[k]
+        total = reference_voxels[k] + test_voxels[k]
+        rows.append({
+            'label': int(label),
+            'reference_voxels': int(reference_voxels[k]),
+            'test_voxels': int(test_voxels[k]),
+            'intersection_voxels': int(intersection[k]),
+            'dice': 2.0 * intersection[k] / total if total else 1.0,
+            'jaccard': intersection[k] / union if union else 1.0,
+            'volume_difference_mm3': (int(test_voxels[k]) - int(reference_voxels[k])) * voxel_mm3,
+            'relative_volume_difference': (
+                (int(test_voxels[k]) - int(reference_voxels[k])) / reference_voxels[k]
+                if reference_voxels[k] else float('nan')
+            ),
+        })
+    return rows
+
+def evaluate_pair(pair):
+    """Overlap rows of one pairs-file row."""
+    labels, matrix = confusion_matrix(load_labels(pair['reference']), load_labels(pair['test']))
+    rows = overlap_table(labels, matrix, voxel_volume(pair['reference']))
+    for row in rows:
+        row['subject'] = pair['subject']
+        row['variant'] = pair['variant']
+    return rows
+
+def read_pairs(pairs_path):
+    """Reads the rows of a pairs file."""
+    with open(pairs_path, newline='') as f:
+        pairs = [row for row in csv.DictReader(f)]
+    for pair in pairs:
+        missing = {'subject', 'variant', 'reference', 'test'} - set(pair)
+        if missing:
+            raise ValueError(f"Pairs file {pairs_path} is missing columns: {sorted(missing)}")
+    return pairs
+
+def run_pairs(pairs, output_path, workers=None):
+    """Evaluates all pairs on a process pool and writes one CSV table, in input order."""
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(evaluate_pair, pairs))
+
+    with open(output_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        for rows in results:
+            writer.writerows(rows)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-label Dice, Jaccard and volume differences of segmentation pairs.")
+    parser.add_argument('pairs', help="CSV file with the columns subject, variant, reference and test")
+    parser.add_argument('--output', required=True, help="Output CSV table (one row per pair and label)")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Number of worker processes (default: number of CPUs)")
+    args = parser.parse_args()
+
+    pairs = read_pairs(args.pairs)
+    results = run_pairs(pairs, args.output, args.workers)
+    print(f"Wrote {sum(len(rows) for rows in results)} rows for {len(pairs)} pairs -> {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+# parallel_warp.py
+#
+# Multi-core warp backend. The spline prefilter, map_coordinates and zoom are
+# split into independent blocks that are evaluated on a thread pool, or on a
+# process pool with shared memory. Every block runs exactly the same scipy
+# arithmetic as the serial call, so the results are bit-identical to
+# scipy.ndimage.map_coordinates / zoom for any number of workers.
+
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import SimpleITK as sitk
+import scipy.ndimage
+from scipy.ndimage import map_coordinates
+
+def set_number_of_threads(threads):
+    """Sets the SimpleITK global thread count used by ResampleImageFilter and registration."""
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(int(threads))
+
+def _blocks(n, parts):
+    """Splits range(n) into at most parts contiguous slices."""
+    bounds = np.linspace(0, n, min(parts, n) + 1).astype(int)
+    return [slice(lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+
+def parallel_spline_filter(array, order=3, mode='mirror', workers=None):
+    """Multi-threaded equivalent of scipy.ndimage.spline_filter(array, order, np.float64, mode)."""
+    workers = workers or os.cpu_count()
+    if order in (0, 1) or workers == 1:
+        return scipy.ndimage.spline_filter(array, order, output=np.float64, mode=mode)
+
+    coefficients = np.array(array, dtype=np.float64)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for axis in range(coefficients.ndim):
+            # Lines along `axis` are independent, so split across another axis
+            split_axis = 0 if axis != 0 else 1
+            def filter_block(block):
+                index = [slice(None)] * coefficients.ndim
+                index[split_axis] = block
+                view = coefficients[tuple(index)]
+                scipy.ndimage.spline_filter1d(view, order, axis=axis, output=view, mode=mode)
+            list(executor.map(filter_block, _blocks(coefficients.shape[split_axis], workers)))
+    return coefficients
+
+def _attach(name, shape, dtype):
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def _map_block_shared(spec, block, order, mode, cval):
+    coefficients_shm, coefficients = _attach(*spec['coefficients'])
+    coordinates_shm, coordinates = _attach(*spec['coordinates'])
+    output_shm, output = _attach(*spec['output'])
+    try:
+        output[block] = map_coordinates(
+            coefficients, coordinates[:, block], output=output.dtype,
+            order=order, mode=mode, cval=cval, prefilter=False
+        )
+    finally:
+        coefficients_shm.close()
+        coordinates_shm.close()
+        output_shm.close()
+
+def _to_shared(array):
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype)
+
+def parallel_map_coordinates(input, coordinates, order=3, mode='constant', cval=0.0,
+                             workers=None, backend='thread'):
+    """Block-parallel scipy.ndimage.map_coordinates with bit-identical results.
+
+    The input is prefiltered once (in parallel), then the output is split
+    along its first axis and each block is interpolated on a thread pool
+    (backend='thread') or a process pool sharing the arrays through shared
+    memory (backend='process').
+    """
+    if order > 1 and mode in ('nearest', 'grid-constant'):
+        # scipy pads the input before prefiltering in these modes, which
+        # cannot be reproduced block by block
+        raise ValueError(f"mode {mode!r} is not supported by the parallel backend")
+    workers = workers or os.cpu_count()
+    coordinates = np.asarray(coordinates)
+    if not np.issubdtype(coordinates.dtype, np.floating):
+        coordinates = coordinates.astype(np.float64)
+    output_dtype = np.asarray(input).dtype
+    if order > 1:
+        coefficients = parallel_spline_filter(input, order, mode=mode, workers=workers)
+    else:
+        coefficients = np.asarray(input)
+
+    blocks = _blocks(coordinates.shape[1], workers)
+    if backend == 'thread':
+        output = np.empty(coordinates.shape[1:], dtype=output_dtype)
+        def map_block(block):
+            output[block] = map_coordinates(
+                coefficients, coordinates[:, block], output=output_dtype,
+                order=order, mode=mode, cval=cval, prefilter=False
+            )
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(map_block, blocks))
+        return output
+
+    if backend != 'process':
+        raise ValueError(f"Unknown backend {backend!r}, expected 'thread' or 'process'")
+
+    shared = {}
+    blocks_shm = []
+    try:
+        for key, array in (('coefficients', coefficients), ('coordinates', coordinates),
+                           ('output', np.empty(coordinates.shape[1:], dtype=output_dtype))):
+            shm, shared[key] = _to_shared(array)
+            blocks_shm.append(shm)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(_map_block_shared, shared, block, order, mode, cval)
+                for block in blocks
+            ]
+            for future in futures:
+                future.result()
+        _, output = _attach(*shared['output'])
+        return output.copy()
+    finally:
+        for shm in blocks_shm:
+            shm.close()
+            shm.unlink()
+
+def zoom_coordinates(input_shape, output_shape, rows=slice(None)):
+    """Input coordinates sampled by scipy.ndimage.zoom for the given output rows."""
+    axes = []
+    for n_in, n_out in zip(input_shape, output_shape):
+        step = (n_in - 1) / (n_out - 1) if n_out > 1 else 1.0
+        axes.append(np.arange(n_out, dtype=np.float64) * step)
+    axes[0] = axes[0][rows]
+    return np.array(np.meshgrid(*axes, indexing='ij'))
+
+def parallel_zoom(input, zoom, order=3, mode='constant', cval=0.0, workers=None):
+    """Multi-threaded scipy.ndimage.zoom with bit-identical results."""
+    if order > 1 and mode in ('nearest', 'grid-constant'):
+        raise ValueError(f"mode {mode!r} is not supported by the parallel backend")
+    workers = workers or os.cpu_count()
+    zoom = np.broadcast_to(zoom, (input.ndim,))
+    output_shape = tuple(int(round(n * z)) for n, z in zip(input.shape, zoom))
+    if order > 1:
+        coefficients = parallel_spline_filter(input, order, mode=mode, workers=workers)
+    else:
+        coefficients = np.asarray(input)
+
+    output = np.empty(output_shape, dtype=input.dtype)
+    def zoom_block(block):
+        output[block] = map_coordinates(
+            coefficients, zoom_coordinates(input.shape, output_shape, block),
+            output=input.dtype, order=order, mode=mode, cval=cval, prefilter=False
+        )
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(zoom_block, _blocks(output_shape[0], workers)))
+    return output
+
+def zoom_region(input, output_shape, region, order=3, mode='constant', halo=16, workers=1):
+    """scipy.ndimage.zoom of input to output_shape, evaluated for a region (tuple of slices) of the output only.
+
+    Only the input block the region samples, plus halo voxels for the spline
+    prefilter, is prefiltered and interpolated. At the volume border the
+    result equals the whole-volume zoom; inside, the halo keeps the
+    difference below ~1e-9 of the intensity range.
+    """
+    block = []
+    axes = []
+    for n_in, n_out, rows in zip(input.shape, output_shape, region):
+        step = (n_in - 1) / (n_out - 1) if n_out > 1 else 1.0
+        positions = np.arange(rows.start, rows.stop, dtype=np.float64) * step
+        lo = max(int(positions[0]) - 1 - halo, 0)
+        hi = min(int(np.ceil(positions[-1])) + 2 + halo, n_in)
+        block.append(slice(lo, hi))
+        axes.append(positions - lo)
+    coordinates = np.array(np.meshgrid(*axes, indexing='ij'))
+    return parallel_map_coordinates(input[tuple(block)], coordinates, order, mode, workers=workers)
@@ -0,0 +1,217 @@
+# point_transform.py
+#
+# Maps physical points (fiducials, contour vertices of a structure set)
+# through the fused ΔB0+GNL correction without resampling any volume. The
+# corrected volume lives on the target grid (target_grid_image, e.g.
+# 112x128x128); every target voxel p samples the acquired MR volume at the
+# fused coordinates T(p) (fused_coordinates), so
+#
+#   - corrected -> acquired is a direct evaluation of T, and
+#   - acquired -> corrected needs T^-1, which is computed once on the MR grid
+#     by fixed-point iteration, cached on disk and then only interpolated.
+#
+# Points are (N, 3) arrays of physical (x, y, z) coordinates in mm, in the
+# SimpleITK (LPS) convention.
+#
+# Usage:
+#     python src/point_transform.py MR.nii B0_Map.nii --gnl-field field.nii --points points.csv --output corrected_points.csv
+
+import argparse
+import csv
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+import SimpleITK as sitk
+from scipy.ndimage import map_coordinates
+
+from B0_correction import formula, register_b0_map
+from B0_GNL_composed_correction import b0_index_displacement, fused_coordinates, target_grid_image
+from dtype_policy import DEFAULT_DTYPE
+from gnl_field_cache import (
+    DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES, cache_key, evict_lru, resample_phantom_field_cached
+)
+
+INVERSE_CACHE_DIR = os.path.join(os.path.dirname(DEFAULT_CACHE_DIR), 'inverse_fields')
+
+def physical_to_index(points, image):
+    """Continuous array indices (3, N) in (z, y, x) order of physical points (N, 3)."""
+    direction = np.array(image.GetDirection()).reshape(3, 3)
+    index_to_physical = direction @ np.diag(image.GetSpacing())
+    index = np.linalg.solve(index_to_physical, (np.asarray(points, dtype=np.float64) - image.GetOrigin()).T)
+    return index[::-1]
+
+def index_to_physical(index, image):
+    """Physical points (N, 3) of continuous array indices (3, N) in (z, y, x) order."""
+    direction = np.array(image.GetDirection()).reshape(3, 3)
+    index_to_physical = direction @ np.diag(image.GetSpacing())
+    return (index_to_physical @ index[::-1]).T + image.GetOrigin()
+
+def _sample_field(field, index):
+    """Linearly interpolates a (3, z, y, x) displacement field at indices (3, N)."""
+    return np.array([
+        map_coordinates(component, index, order=1, mode='nearest') for component in field
+    ])
+
+class PointTransformer:
+    """Vectorised point mapping through the fused ΔB0+GNL correction of one subject.
+
+    B0_Map_Array_mm is the registered B0 shift in mm on the grid of image
+    (the acquired MR volume), gnl_field_resampled the phantom field on
+    target_shape (in target voxel units), as for fused_correction. The
+    corrected points refer to the target grid image of the written volumes.
+    """
+
+    def __init__(self, B0_Map_Array_mm, gnl_field_resampled, image, target_shape=None,
+                 cache_dir=INVERSE_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, iterations=30,
+                 tolerance=1e-4, dtype=DEFAULT_DTYPE):
+        self.B0_Map_Array_mm = B0_Map_Array_mm
+        self.gnl_field_resampled = gnl_field_resampled
+        self.image = image
+        if target_shape is None:
+            target_shape = image.GetSize()[::-1]
+        self.target_shape = tuple(int(n) for n in target_shape)
+        self.target_image = target_grid_image(image, self.target_shape)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.iterations = iterations
+        self.tolerance = tolerance
+        self.dtype = np.dtype(dtype)
+        self._inverse = None
+        # Same corner-aligned scaling from target to MR indices as fused_coordinates
+        self._scale = np.array([
+            (n_in - 1) / (n_out - 1) if n_out > 1 else 1.0
+            for n_in, n_out in zip(B0_Map_Array_mm.shape, self.target_shape)
+        ])[:, None]
+        # Contiguous GNL components, so map_coordinates does not copy them per call
+        self._gnl = np.ascontiguousarray(np.moveaxis(np.asarray(gnl_field_resampled), -1, 0))
+
+    def forward_index(self, index):
+        """T in index units: positions (3, N) of the target grid -> positions in the acquired volume.
+
+        The point-wise version of fused_coordinates, with the GNL field
+        interpolated linearly between target voxels.
+        """
+        displaced = (index + _sample_field(self._gnl, index)) * self._scale
+        B0_at_gnl = map_coordinates(self.B0_Map_Array_mm, displaced, order=1, mode='nearest')
+        for i, displacement in enumerate(b0_index_displacement(B0_at_gnl, self.target_image)):
+            if displacement is not None:
+                displaced[i] += displacement * self._scale[i]
+        return displaced
+
+    def corrected_to_acquired(self, points):
+        """Maps physical points of the corrected image to the acquired (distorted) image."""
+        index = physical_to_index(points, self.target_image)
+        return index_to_physical(self.forward_index(index), self.image)
+
+    def inverse_field(self):
+        """Inverse displacement (3, z, y, x) on the MR grid, in target index units.
+
+        For every MR grid point q, T^-1(q) = q / s + v(q), with s the target to
+        MR index scaling, solves T(p) = q with the fixed-point iteration
+        p <- q / s - u(p), where u = T / s - identity is the forward
+        displacement on the target grid, interpolated linearly. The result is
+        cached on disk, keyed by the forward field and the MR grid.
+        """
+        if self._inverse is not None:
+            return self._inverse
+
+        coordinates = fused_coordinates(
+            self.B0_Map_Array_mm, self.gnl_field_resampled, self.target_image, dtype=self.dtype
+        )
+        scale = self._scale.reshape(3, 1, 1, 1).astype(self.dtype)
+        forward = coordinates / scale - np.indices(self.target_shape, dtype=self.dtype)
+        del coordinates
+
+        digest = hashlib.sha256(forward.tobytes() + str(forward.shape).encode()).hexdigest()
+        key = cache_key(digest, self.B0_Map_Array_mm.shape, self.image.GetSpacing(), self.image.GetOrigin(),
+                        self.image.GetDirection(), self.dtype)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entry_path = os.path.join(self.cache_dir, key + '.npy')
+        if os.path.exists(entry_path):
+            os.utime(entry_path)
+            self._inverse = np.load(entry_path, mmap_mode='r')
+            return self._inverse
+
+        targets = (np.indices(self.B0_Map_Array_mm.shape, dtype=self.dtype).reshape(3, -1)
+                   / self._scale.astype(self.dtype))
+        inverse = np.zeros_like(targets)
+        for _ in range(self.iterations):
+            update = -_sample_field(forward, targets + inverse)
+            change = np.abs(update - inverse).max()
+            inverse = update.astype(self.dtype, copy=False)
+            if change < self.tolerance:
+                break
+        inverse = inverse.reshape((3,) + self.B0_Map_Array_mm.shape)
+
+        # Same atomic write and LRU eviction as the GNL field cache
+        fd, tmp_path = tempfile.mkstemp(suffix='.npy.tmp', dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, inverse)
+        os.replace(tmp_path, entry_path)
+        evict_lru(self.cache_dir, self.max_bytes, keep=(entry_path,))
+        self._inverse = np.load(entry_path, mmap_mode='r')
+        return self._inverse
+
+    def acquired_to_corrected(self, points):
+        """Maps physical points of the acquired (distorted) image to the corrected image."""
+        index = physical_to_index(points, self.image)
+        corrected = index / self._scale + _sample_field(self.inverse_field(), index)
+        return index_to_physical(corrected, self.target_image)
+
+    def transform_contours(self, contours, inverse=True):
+        """Maps a list of (N_i, 3) contours in one vectorised call.
+
+        inverse=True maps contours drawn on the acquired image to the
+        corrected image, inverse=False the other way round.
+        """
+        if not contours:
+            return []
+        points = np.concatenate([np.asarray(contour, dtype=np.float64) for contour in contours])
+        mapped = self.acquired_to_corrected(points) if inverse else self.corrected_to_acquired(points)
+        bounds = np.cumsum([len(contour) for contour in contours])[:-1]
+        return np.split(mapped, bounds)
+
+def subject_transformer(MR_Volume, B0_Map, gnl_field_path, target_shape=(112, 128, 128), params=None,
+                        **options):
+    """Registers the B0 map and builds the PointTransformer of a subject for the target grid."""
+    final_transform, B0_Map_Resampled = register_b0_map(MR_Volume, B0_Map)
+    B0_Map_Array_mm = formula(sitk.GetArrayFromImage(B0_Map_Resampled).astype(DEFAULT_DTYPE), **(params or {}))
+    gnl_field_resampled = resample_phantom_field_cached(gnl_field_path, MR_Volume, target_shape)
+    return PointTransformer(B0_Map_Array_mm, gnl_field_resampled, MR_Volume, target_shape, **options)
+
+def main():
+    parser = argparse.ArgumentParser(description="Map physical points through the B0+GNL correction.")
+    parser.add_argument('mr', help="Acquired MR volume")
+    parser.add_argument('b0_map', help="Static field map of the same subject")
+    parser.add_argument('--gnl-field', required=True, help="Phantom GNL displacement field (NIfTI)")
+    parser.add_argument('--points', required=True, help="CSV file with the columns x, y and z (mm)")
+    parser.add_argument('--output', required=True, help="CSV file for the mapped points")
+    parser.add_argument('--target-shape', type=int, nargs=3, default=(112, 128, 128),
+                        metavar=('Z', 'Y', 'X'), help="Grid of the corrected volumes (default: 112 128 128)")
+    parser.add_argument('--to-acquired', action='store_true',
+                        help="Map corrected-image points to the acquired image instead")
+    args = parser.parse_args()
+
+    with open(args.points, newline='') as f:
+        rows = list(csv.DictReader(f))
+    points = np.array([[float(row['x']), float(row['y']), float(row['z'])] for row in rows])
+
+    transformer = subject_transformer(
+        sitk.ReadImage(args.mr), sitk.ReadImage(args.b0_map), args.gnl_field, tuple(args.target_shape)
+    )
+    if args.to_acquired:
+        mapped = transformer.corrected_to_acquired(points)
+    else:
+        mapped = transformer.acquired_to_corrected(points)
+
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]) if rows else ['x', 'y', 'z'])
+        writer.writeheader()
+        for row, (x, y, z) in zip(rows, mapped):
+            writer.writerow(dict(row, x=x, y=y, z=z))
+    print(f"Mapped {len(points)} points -> {args.output}")
+
+if __name__ == "__main__":
+    main()
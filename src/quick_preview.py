@@ -0,0 +1,192 @@
+# quick_preview.py
+#
+# Quick-preview ΔB0+GNL correction for QA at the console. The B0 map is
+# registered at the coarsest pyramid level only, and the MR volume is warped
+# onto every second (--shrink) voxel of the target grid of the full
+# correction with linear interpolation, so the mid-slice triptych of
+# B0_correction.main and a displacement summary are available within a
+# second or so. The full-quality correction (full registration,
+# warm-started from the preview transform, and the fused cubic warp onto the
+# target grid) then continues in a background process.
+#
+# Usage:
+#     python src/quick_preview.py MR.nii B0_Map.nii --gnl-field field.nii --figure preview.png --full-output results/mouse_35_b0_gnl.nii
+
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import SimpleITK as sitk
+from scipy.ndimage import map_coordinates
+
+from array_store import write_output_atomic
+from B0_correction import formula, plot_b0_correction, register_b0_map
+from B0_GNL_composed_correction import correct_with_b0_shift, fused_coordinates, target_grid_image
+from dtype_policy import DEFAULT_DTYPE
+from gnl_field_cache import resample_phantom_field_cached
+
+def preview_coordinates(B0_Map_Array_mm, gnl_field_resampled, target_image, shrink=2,
+                        dtype=DEFAULT_DTYPE):
+    """Fused sampling coordinates of every shrink-th voxel of the target grid.
+
+    gnl_field_resampled is the phantom field on the target grid, as for the
+    full correction, so the preview samples the MR volume exactly where the
+    full correction does at the same voxels.
+    """
+    region = (slice(None, None, shrink),) * 3
+    return fused_coordinates(B0_Map_Array_mm, gnl_field_resampled, target_image, region, dtype)
+
+def preview_grid_image(target_image, shrink=2):
+    """Geometry of every shrink-th voxel of the target grid."""
+    size = [(n + shrink - 1) // shrink for n in target_image.GetSize()]
+    preview_grid = sitk.Image(size, sitk.sitkUInt8)
+    preview_grid.SetOrigin(target_image.GetOrigin())
+    preview_grid.SetSpacing([sp * shrink for sp in target_image.GetSpacing()])
+    preview_grid.SetDirection(target_image.GetDirection())
+    return preview_grid
+
+def displacement_summary(coordinates, B0_Map_Array_mm, MR_Volume, target_shape, shrink=2):
+    """Magnitude statistics (mm) of the composed displacement and of the B0 shift.
+
+    coordinates are the fused sampling coordinates of every shrink-th voxel
+    of the target grid in index units of the MR grid, as returned by
+    preview_coordinates.
+    """
+    source_shape = MR_Volume.GetSize()[::-1]
+    spacing = MR_Volume.GetSpacing()[::-1]
+    squared = np.zeros(coordinates.shape[1:])
+    for i, (n_in, n_out) in enumerate(zip(source_shape, target_shape)):
+        # Same corner-aligned scaling as fused_coordinates
+        scale = (n_in - 1) / (n_out - 1) if n_out > 1 else 1.0
+        position = np.arange(0, n_out, shrink).reshape([-1 if axis == i else 1 for axis in range(3)]) * scale
+        squared += ((coordinates[i] - position) * spacing[i]) ** 2
+    magnitude = np.sqrt(squared)
+    b0_shift = np.abs(B0_Map_Array_mm)
+    return {
+        'displacement_mean_mm': float(magnitude.mean()),
+        'displacement_p95_mm': float(np.percentile(magnitude, 95)),
+        'displacement_max_mm': float(magnitude.max()),
+        'b0_shift_mean_mm': float(b0_shift.mean()),
+        'b0_shift_max_mm': float(b0_shift.max()),
+    }
+
+def preview_correction(MR_Volume, B0_Map, gnl_field_path, shrink=2, params=None, mask=None,
+                       target_shape=(112, 128, 128), dtype=DEFAULT_DTYPE):
+    """Coarse ΔB0+GNL correction of one scan for QA.
+
+    Returns a dict with the preview image (every shrink-th voxel of the
+    target grid of the full correction), the B0 shift in mm on the MR grid,
+    the coarse registration transform and the displacement summary.
+    """
+    dtype = np.dtype(dtype)
+    final_transform, B0_Map_Resampled = register_b0_map(MR_Volume, B0_Map, mask=mask, coarse_only=True)
+    B0_Map_Array_mm = formula(
+        sitk.GetArrayFromImage(B0_Map_Resampled).astype(dtype, copy=False), **(params or {})
+    )
+
+    # The same (cached) GNL field as the full correction, read at the preview voxels only
+    target_image = target_grid_image(MR_Volume, target_shape)
+    gnl_field_resampled = resample_phantom_field_cached(gnl_field_path, MR_Volume, target_shape, dtype=dtype)
+    coordinates = preview_coordinates(B0_Map_Array_mm, gnl_field_resampled, target_image, shrink, dtype)
+    preview_array = map_coordinates(
+        sitk.GetArrayViewFromImage(MR_Volume), coordinates, output=dtype, order=1, mode='constant', cval=0.0
+    )
+
+    preview = sitk.GetImageFromArray(preview_array)
+    preview.CopyInformation(preview_grid_image(target_image, shrink))
+    return {
+        'preview': preview,
+        'B0_Map_Array_mm': B0_Map_Array_mm,
+        'transform': final_transform,
+        'summary': displacement_summary(coordinates, B0_Map_Array_mm, MR_Volume, target_shape, shrink),
+    }
+
+def full_correction(mr_path, b0_path, gnl_field_path, output_path, target_shape=(112, 128, 128),
+                    transform_path=None, params=None):
+    """Full-quality correction of one scan, warm-started from a saved transform; returns seconds."""
+    start = time.perf_counter()
+    MR_Volume = sitk.ReadImage(mr_path)
+    B0_Map = sitk.ReadImage(b0_path)
+    initial_transform = None
+    if transform_path:
+        initial_transform = sitk.ReadTransform(transform_path)
+        os.remove(transform_path)
+
+    final_transform, B0_Map_Resampled = register_b0_map(MR_Volume, B0_Map, initial_transform=initial_transform)
+    B0_Map_Array_mm = formula(
+        sitk.GetArrayFromImage(B0_Map_Resampled).astype(DEFAULT_DTYPE), **(params or {})
+    )
+    gnl_field_resampled = resample_phantom_field_cached(gnl_field_path, MR_Volume, target_shape)
+    corrected_volume = correct_with_b0_shift(MR_Volume, B0_Map_Array_mm, gnl_field_resampled, target_shape)
+    write_output_atomic(corrected_volume, output_path, workers=1)
+    return time.perf_counter() - start
+
+def start_full_correction(executor, mr_path, b0_path, gnl_field_path, output_path, transform,
+                          target_shape=(112, 128, 128), params=None):
+    """Submits full_correction to executor, warm-started from transform; returns the future."""
+    # Transforms travel to the worker as a .tfm file
+    fd, transform_path = tempfile.mkstemp(suffix='.tfm', dir=os.path.dirname(output_path) or '.')
+    os.close(fd)
+    sitk.WriteTransform(transform, transform_path)
+    return executor.submit(
+        full_correction, mr_path, b0_path, gnl_field_path, output_path, tuple(target_shape),
+        transform_path, params
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Quick-preview B0+GNL correction for QA at the console.")
+    parser.add_argument('mr', help="Acquired MR volume")
+    parser.add_argument('b0_map', help="Static field map of the same scan")
+    parser.add_argument('--gnl-field', required=True, help="Phantom GNL field (NIfTI or B-spline .npz)")
+    parser.add_argument('--shrink', type=int, default=2, help="Preview every SHRINK-th voxel of the target grid (default: 2)")
+    parser.add_argument('--figure', help="Save the mid-slice triptych to this image file")
+    parser.add_argument('--show', action='store_true', help="Show the mid-slice triptych")
+    parser.add_argument('--full-output', help="Run the full correction in the background and write it here")
+    parser.add_argument('--target-shape', type=int, nargs=3, default=(112, 128, 128),
+                        metavar=('Z', 'Y', 'X'), help="Grid of the full correction (default: 112 128 128)")
+    args = parser.parse_args()
+
+    # 1. Load the MR volume and B0 map
+    start = time.perf_counter()
+    MR_Volume = sitk.ReadImage(args.mr)
+    B0_Map = sitk.ReadImage(args.b0_map)
+
+    # 2. Coarse registration and downsampled linear warp
+    result = preview_correction(
+        MR_Volume, B0_Map, args.gnl_field, args.shrink, target_shape=tuple(args.target_shape)
+    )
+    print(f"Preview ready in {time.perf_counter() - start:.2f} s", flush=True)
+    for name, value in result['summary'].items():
+        print(f"  {name:<22s} {value:.3f}", flush=True)
+
+    # 3. Full-quality correction in a background process
+    executor = None
+    if args.full_output:
+        executor = ProcessPoolExecutor(max_workers=1)
+        future = start_full_correction(
+            executor, args.mr, args.b0_map, args.gnl_field, args.full_output, result['transform'],
+            args.target_shape
+        )
+        print(f"Full correction running in the background -> {args.full_output}", flush=True)
+
+    # 4. Mid-slice triptych, as in B0_correction.main
+    if args.figure or args.show:
+        figure = plot_b0_correction(
+            sitk.GetArrayViewFromImage(MR_Volume), result['B0_Map_Array_mm'],
+            sitk.GetArrayViewFromImage(result['preview']), show=False
+        )
+        if args.figure:
+            figure.savefig(args.figure)
+        if args.show:
+            import matplotlib.pyplot as plt
+            plt.show()
+
+    if executor is not None:
+        print(f"Full correction written ({future.result():.1f} s) -> {args.full_output}", flush=True)
+        executor.shutdown()
+
+if __name__ == "__main__":
+    main()
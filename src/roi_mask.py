@@ -0,0 +1,83 @@
+# roi_mask.py
+#
+# Region of interest for mask-restricted correction. Most of the field of
+# view of the mouse scans is air or the holder; with a region of interest the
+# warp engines evaluate the displacement and interpolate only inside it and
+# fill everything else with the default value 0, while the output geometry
+# stays the same.
+#
+# A region of interest is given as
+#
+#   - 'auto': Otsu foreground of the MR volume, dilated by a margin that
+#     covers the largest expected displacement,
+#   - a bounding box (x0, y0, z0, x1, y1, z1) in voxel indices of the MR
+#     volume (start inclusive, end exclusive, as SimpleITK regions), or
+#   - a binary mask image on the MR grid (SimpleITK image or file path).
+
+import numpy as np
+import SimpleITK as sitk
+import scipy.ndimage
+
+def foreground_mask(image):
+    """Binary foreground mask of image from Otsu thresholding."""
+    return sitk.OtsuThreshold(image, 0, 1)
+
+def automatic_mask(image, margin=4):
+    """Otsu foreground of image dilated by margin voxels, as a uint8 image."""
+    mask = foreground_mask(image)
+    if margin > 0:
+        mask = sitk.BinaryDilate(mask, [int(margin)] * 3, sitk.sitkBox)
+    return sitk.Cast(mask, sitk.sitkUInt8)
+
+def box_mask(image, box):
+    """uint8 mask image on the grid of image that is 1 inside the (x0, y0, z0, x1, y1, z1) box."""
+    x0, y0, z0, x1, y1, z1 = [int(v) for v in box]
+    mask_array = np.zeros(image.GetSize()[::-1], dtype=np.uint8)
+    mask_array[max(z0, 0):z1, max(y0, 0):y1, max(x0, 0):x1] = 1
+    mask = sitk.GetImageFromArray(mask_array)
+    mask.CopyInformation(image)
+    return mask
+
+def parse_roi(argument):
+    """Parses a command line region of interest: 'auto', 'x0,y0,z0,x1,y1,z1' or a mask file path."""
+    if argument is None or argument == 'auto':
+        return argument
+    parts = argument.split(',')
+    if len(parts) == 6:
+        try:
+            return tuple(int(v) for v in parts)
+        except ValueError:
+            pass
+    return argument
+
+def roi_mask_image(image, roi, margin=4):
+    """Binary mask image on the grid of image for a region of interest, or None without one."""
+    if roi is None:
+        return None
+    if isinstance(roi, str) and roi == 'auto':
+        return automatic_mask(image, margin)
+    if isinstance(roi, str):
+        roi = sitk.ReadImage(roi)
+    if isinstance(roi, sitk.Image):
+        if roi.GetSize() != image.GetSize():
+            raise ValueError(f"ROI mask size {roi.GetSize()} differs from the image size {image.GetSize()}")
+        return sitk.Cast(roi != 0, sitk.sitkUInt8)
+    return box_mask(image, roi)
+
+def target_mask(mask_image, target_shape):
+    """(z, y, x) boolean mask on target_shape, with the corner-aligned scaling of scipy.ndimage.zoom."""
+    mask_array = sitk.GetArrayViewFromImage(mask_image) != 0
+    if mask_array.shape == tuple(target_shape):
+        return mask_array
+    zoom_factors = [t / s for t, s in zip(target_shape, mask_array.shape)]
+    return scipy.ndimage.zoom(mask_array.astype(np.uint8), zoom_factors, order=0) != 0
+
+def bounding_box(mask):
+    """Tuple of slices of the nonzero extent of mask along every axis, or None if mask is empty."""
+    extents = []
+    for axis in range(mask.ndim):
+        present = np.flatnonzero(mask.any(axis=tuple(a for a in range(mask.ndim) if a != axis)))
+        if present.size == 0:
+            return None
+        extents.append(slice(int(present[0]), int(present[-1]) + 1))
+    return tuple(extents)
@@ -0,0 +1,117 @@
+# series_correction.py
+#
+# B0+GNL correction of 4-D series (multi-echo GRE, dynamic series). All frames
+# share geometry, B0 map and GNL field, so the registration and the fused
+# upsampling + correction coordinates are computed once per series; each frame
+# is then read and interpolated once on its own, and written into a
+# preallocated memory-mapped output before the next frame is read, so only
+# one frame is held in memory.
+#
+# Usage:
+#     python src/series_correction.py series.nii B0_Map.nii --gnl-field field.nii --output corrected.nii
+
+import argparse
+import itertools
+import os
+
+import nibabel as nib
+import SimpleITK as sitk
+
+from B0_correction import formula, register_b0_map
+from B0_GNL_composed_correction import fused_coordinates, target_grid_image, warp_volume
+from dtype_policy import DEFAULT_DTYPE
+from gnl_field_cache import resample_phantom_field_cached
+from nifti_mmap import create_nifti_memmap, is_uncompressed_nifti, read_image_information
+from parallel_warp import set_number_of_threads
+
+def series_frames(series_path):
+    """Yields the 3-D frames of a 3-D or 4-D image file, reading one frame at a time."""
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(series_path)
+    reader.ReadImageInformation()
+    size = list(reader.GetSize())
+    if len(size) == 3:
+        yield reader.Execute()
+        return
+
+    for t in range(size[3]):
+        reader.SetExtractIndex([0, 0, 0, t])
+        reader.SetExtractSize(size[:3] + [0])
+        yield reader.Execute()
+
+def correct_series(series_path, B0_Map, gnl_field_path, target_shape=(112, 128, 128), workers=1):
+    """Yields the corrected 3-D image of every frame of a series."""
+    frames = series_frames(series_path)
+    first_frame = next(frames)
+
+    # Registration, B0 shift and composed coordinates are shared by all frames
+    final_transform, B0_Map_Resampled = register_b0_map(first_frame, B0_Map)
+    B0_Map_Array_mm = formula(sitk.GetArrayFromImage(B0_Map_Resampled).astype(DEFAULT_DTYPE))
+    gnl_field_resampled = resample_phantom_field_cached(gnl_field_path, first_frame, target_shape)
+
+    target_image = target_grid_image(first_frame, target_shape)
+    coordinates = fused_coordinates(B0_Map_Array_mm, gnl_field_resampled, target_image)
+
+    for frame in itertools.chain([first_frame], frames):
+        Frame_Array = sitk.GetArrayFromImage(frame).astype(DEFAULT_DTYPE, copy=False)
+        corrected_frame = sitk.GetImageFromArray(
+            warp_volume(Frame_Array, coordinates, workers=workers)
+        )
+        corrected_frame.CopyInformation(target_image)
+        yield corrected_frame
+
+def write_frames(frames, series_path, output_path):
+    """Writes corrected 3-D frames one at a time into a .nii with the time geometry of the input series.
+
+    The output is preallocated as a memory map when the first frame
+    arrives; a compressed output is written from a temporary uncompressed
+    file. Returns the number of frames.
+    """
+    reader = read_image_information(series_path)
+    mmap_path = output_path if is_uncompressed_nifti(output_path) else output_path + '.tmp.nii'
+    output = None
+    count = 0
+    for count, frame in enumerate(frames, 1):
+        Frame_Array = sitk.GetArrayViewFromImage(frame)
+        if output is None:
+            if reader.GetDimension() == 3:
+                output = create_nifti_memmap(mmap_path, frame, Frame_Array.dtype)
+            else:
+                output = create_nifti_memmap(
+                    mmap_path, frame, Frame_Array.dtype, (reader.GetSize()[3],) + Frame_Array.shape,
+                    reader.GetOrigin()[3], reader.GetSpacing()[3]
+                )
+        if output.ndim == 3:
+            output[...] = Frame_Array
+        else:
+            output[count - 1] = Frame_Array
+    output.flush()
+    del output
+
+    if mmap_path != output_path:
+        nib.save(nib.load(mmap_path), output_path)
+        os.remove(mmap_path)
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description="B0+GNL distortion correction of a 4-D series.")
+    parser.add_argument('series', help="3-D or 4-D MR series (NIfTI)")
+    parser.add_argument('b0_map', help="Static field map of the same session")
+    parser.add_argument('--gnl-field', required=True, help="Phantom GNL displacement field (NIfTI)")
+    parser.add_argument('--output', required=True, help="Corrected series (NIfTI, .nii is written frame by frame)")
+    parser.add_argument('--target-shape', type=int, nargs=3, default=(112, 128, 128),
+                        metavar=('Z', 'Y', 'X'), help="Upsampled grid shape (default: 112 128 128)")
+    args = parser.parse_args()
+
+    workers = os.cpu_count()
+    set_number_of_threads(workers)
+
+    B0_Map = sitk.ReadImage(args.b0_map)
+    corrected_frames = correct_series(
+        args.series, B0_Map, args.gnl_field, tuple(args.target_shape), workers
+    )
+    count = write_frames(corrected_frames, args.series, args.output)
+    print(f"Corrected {count} frame(s) -> {args.output}")
+
+if __name__ == "__main__":
+    main()
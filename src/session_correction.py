@@ -0,0 +1,120 @@
+# session_correction.py
+#
+# Session-level correction: one static field map, several MR sequences
+# acquired with the same animal position. The B0 map is registered once (to
+# the first sequence) and resampled once per distinct sequence grid; only the
+# conversion to a millimetre shift, whose gradient constants differ per
+# sequence, and the warp itself are repeated for every sequence.
+#
+# Session file (JSON):
+#
+#     {
+#         "b0_map": "data/B0_Map_Mouse.nii",
+#         "gnl_field": "data/Cropped_Displacement_Field_Mouse_Dimensions.nii",
+#         "target_shape": [112, 128, 128],
+#         "roi": "auto",
+#         "sequences": [
+#             {"mr": "data/FLASH.nii", "output": "results/FLASH_b0_gnl.nii",
+#              "G_read_percentFLASH": 0.05563298, "PVM_GradCal": 42797.5},
+#             {"mr": "data/RARE.nii", "output": "results/RARE_b0_gnl.nii",
+#              "G_read_percentFLASH": 0.0412, "PVM_GradCal": 42797.5}
+#         ]
+#     }
+#
+# Outputs ending in .zarr are written as chunked, compressed zarr arrays. The
+# optional roi ('auto', [x0, y0, z0, x1, y1, z1] or a mask file, see roi_mask)
+# restricts the warp of every sequence to a region of interest; a sequence
+# may give its own.
+#
+# With --store-fields DIR the B0 shift map in mm of every sequence
+# (DIR/<output>_b0_shift_mm.zarr, on the sequence grid) and the resampled GNL
+# field of every distinct sequence grid (DIR/<output>_gnl_field.zarr, named
+# after the first sequence on that grid) are stored as chunked zarr arrays.
+#
+# Usage:
+#     python src/session_correction.py session.json
+
+import argparse
+import json
+import os
+
+import SimpleITK as sitk
+
+from array_store import field_store_path, write_output, write_volume
+from B0_correction import formula, register_b0_map
+from B0_GNL_composed_correction import correct_with_b0_shift, target_grid_image
+from dtype_policy import DEFAULT_DTYPE
+from gnl_field_cache import resample_phantom_field_cached
+from parallel_warp import set_number_of_threads
+
+def _geometry_key(image):
+    return (image.GetSize(), image.GetSpacing(), image.GetOrigin(), image.GetDirection())
+
+def correct_session(session, workers=1, store_fields=None):
+    """Corrects all sequences of a session description and yields (sequence, corrected image).
+
+    With store_fields (a directory) the B0 shift maps and the resampled GNL
+    fields are written there as zarr arrays.
+    """
+    target_shape = tuple(session.get('target_shape', (112, 128, 128)))
+    B0_Map = sitk.ReadImage(session['b0_map'])
+    sequences = session['sequences']
+
+    # Register the B0 map once, to the first sequence
+    reference = sitk.ReadImage(sequences[0]['mr'])
+    final_transform, B0_Map_Resampled = register_b0_map(reference, B0_Map)
+    resampled_b0 = {_geometry_key(reference): sitk.GetArrayFromImage(B0_Map_Resampled)}
+    stored_gnl_fields = set()
+    if store_fields:
+        os.makedirs(store_fields, exist_ok=True)
+
+    for sequence in sequences:
+        MR_Volume = reference if sequence is sequences[0] else sitk.ReadImage(sequence['mr'])
+
+        # Sequences sharing a grid share the resampled B0 map
+        key = _geometry_key(MR_Volume)
+        if key not in resampled_b0:
+            resampled_b0[key] = sitk.GetArrayFromImage(sitk.Resample(
+                B0_Map, MR_Volume, final_transform, sitk.sitkLinear, 0.0, B0_Map.GetPixelID()
+            ))
+
+        gradient = {k: sequence[k] for k in ('G_read_percentFLASH', 'PVM_GradCal') if k in sequence}
+        B0_Map_Array_mm = formula(resampled_b0[key].astype(DEFAULT_DTYPE), **gradient)
+
+        gnl_field_resampled = resample_phantom_field_cached(session['gnl_field'], MR_Volume, target_shape)
+        if store_fields:
+            write_volume(field_store_path(store_fields, sequence['output'], 'b0_shift_mm'),
+                         B0_Map_Array_mm, MR_Volume, workers=workers)
+            if key not in stored_gnl_fields:
+                write_volume(field_store_path(store_fields, sequence['output'], 'gnl_field'),
+                             gnl_field_resampled, target_grid_image(MR_Volume, target_shape),
+                             workers=workers)
+                stored_gnl_fields.add(key)
+        roi = sequence.get('roi', session.get('roi'))
+        yield sequence, correct_with_b0_shift(
+            MR_Volume, B0_Map_Array_mm, gnl_field_resampled, target_shape, workers,
+            roi=tuple(roi) if isinstance(roi, list) else roi
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description="B0+GNL correction of all sequences of a session.")
+    parser.add_argument('session', help="Session description (JSON)")
+    parser.add_argument('--store-fields', metavar='DIR',
+                        help="Also store the B0 shift maps and resampled GNL fields as zarr arrays in DIR")
+    args = parser.parse_args()
+
+    with open(args.session) as f:
+        session = json.load(f)
+
+    workers = os.cpu_count()
+    set_number_of_threads(workers)
+
+    for sequence, corrected_volume in correct_session(session, workers, args.store_fields):
+        output_dir = os.path.dirname(sequence['output'])
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        write_output(corrected_volume, sequence['output'], workers)
+        print(f"{sequence['mr']} -> {sequence['output']}")
+
+if __name__ == "__main__":
+    main()
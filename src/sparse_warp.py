@@ -0,0 +1,156 @@
+# sparse_warp.py
+#
+# For a fixed grid and a fixed composed B0+GNL field, the fused upsampling and
+# single-pass interpolation is a linear operator. This module builds it once
+# as a sparse matrix (nearest-neighbour, trilinear or truncated cubic weights)
+# so any number of volumes on the same grid - a cohort re-correction, all
+# channels or echoes of a scan, label maps - can be corrected with a single
+# sparse matrix product.
+#
+# Usage:
+#     python src/sparse_warp.py MR.nii B0_Map.nii --gnl-field field.nii --output warp_operator.npz
+
+import argparse
+
+import numpy as np
+import scipy.sparse
+import SimpleITK as sitk
+
+from B0_correction import formula, register_b0_map
+from B0_GNL_composed_correction import fused_coordinates, target_grid_image
+from dtype_policy import DEFAULT_DTYPE
+from gnl_field_cache import resample_phantom_field_cached
+
+def _nearest_weights(x):
+    return np.floor(x + 0.5)[:, None], np.ones((x.size, 1))
+
+def _linear_weights(x):
+    base = np.floor(x)
+    t = x - base
+    return base[:, None] + np.arange(2), np.stack([1 - t, t], axis=1)
+
+def _cubic_weights(x, a=-0.5):
+    """Keys cubic convolution weights; unlike B-splines they need no prefilter."""
+    base = np.floor(x)
+    t = x - base
+    weights = np.stack([
+        ((a * (t + 1) - 5 * a) * (t + 1) + 8 * a) * (t + 1) - 4 * a,
+        ((a + 2) * t - (a + 3)) * t * t + 1,
+        ((a + 2) * (1 - t) - (a + 3)) * (1 - t) * (1 - t) + 1,
+        ((a * (2 - t) - 5 * a) * (2 - t) + 8 * a) * (2 - t) - 4 * a,
+    ], axis=1)
+    return base[:, None] + np.arange(-1, 3), weights
+
+_WEIGHTS = {'nearest': _nearest_weights, 'linear': _linear_weights, 'cubic': _cubic_weights}
+
+def _fold_reflect(index, n):
+    """Folds indices into [0, n) like scipy's 'reflect' (half-sample symmetric) mode."""
+    period = 2 * n
+    index = np.mod(index, period)
+    return np.where(index >= n, period - 1 - index, index)
+
+def build_warp_operator(coordinates, input_shape, interpolation='linear', mode='constant',
+                        rows_per_chunk=1 << 18):
+    """Builds the sparse (N_out, N_in) matrix that samples a volume at coordinates.
+
+    coordinates has shape (3,) + output_shape in input index units. With
+    mode='constant' weights of samples outside the input are dropped (value
+    0); with mode='reflect' indices are folded back into the volume.
+    """
+    if interpolation not in _WEIGHTS:
+        raise ValueError(f"Unknown interpolation {interpolation!r}, expected one of {sorted(_WEIGHTS)}")
+    if mode not in ('constant', 'reflect'):
+        raise ValueError(f"Unknown mode {mode!r}, expected 'constant' or 'reflect'")
+
+    coordinates = np.asarray(coordinates).reshape(3, -1)
+    n_out = coordinates.shape[1]
+    strides = (input_shape[1] * input_shape[2], input_shape[2], 1)
+
+    chunks = []
+    for start in range(0, n_out, rows_per_chunk):
+        stop = min(start + rows_per_chunk, n_out)
+        flat_index = 0
+        weight = 1
+        for axis in range(3):
+            index, axis_weight = _WEIGHTS[interpolation](coordinates[axis, start:stop])
+            index = index.astype(np.int64)
+            if mode == 'reflect':
+                index = _fold_reflect(index, input_shape[axis])
+            else:
+                inside = (index >= 0) & (index < input_shape[axis])
+                axis_weight = np.where(inside, axis_weight, 0.0)
+                index = np.clip(index, 0, input_shape[axis] - 1)
+            # Outer product over the taps of all axes
+            expand = (slice(None),) + (None,) * axis + (slice(None),)
+            flat_index = np.expand_dims(flat_index, -1) + index[expand] * strides[axis]
+            weight = np.expand_dims(weight, -1) * axis_weight[expand]
+
+        taps = flat_index[0].size
+        block = scipy.sparse.csr_matrix(
+            (weight.reshape(-1).astype(np.float32),
+             flat_index.reshape(-1).astype(np.int32),
+             np.arange(stop - start + 1, dtype=np.int64) * taps),
+            shape=(stop - start, int(np.prod(input_shape)))
+        )
+        block.sum_duplicates()
+        block.eliminate_zeros()
+        chunks.append(block)
+    return scipy.sparse.vstack(chunks, format='csr')
+
+def apply_warp_operator(operator, volumes, output_shape, labels=False):
+    """Corrects one volume (3-D) or a stack of volumes (4-D, volumes first) with one product.
+
+    With labels=True (use a nearest-neighbour operator) the result is rounded
+    back to the integer label dtype.
+    """
+    volumes = np.asarray(volumes)
+    stacked = volumes.ndim == 4
+    columns = volumes.reshape(volumes.shape[0], -1).T if stacked else volumes.reshape(-1)
+    result = operator @ columns.astype(np.float32, copy=False)
+
+    if stacked:
+        result = result.T.reshape((volumes.shape[0],) + tuple(output_shape))
+    else:
+        result = result.reshape(output_shape)
+    if labels:
+        return np.rint(result).astype(volumes.dtype)
+    return result.astype(volumes.dtype, copy=False)
+
+def save_warp_operator(path, operator):
+    """Saves the operator as a compressed .npz file."""
+    scipy.sparse.save_npz(path, operator)
+
+def load_warp_operator(path):
+    """Loads an operator saved with save_warp_operator."""
+    return scipy.sparse.load_npz(path).tocsr()
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the sparse B0+GNL warp operator of a subject.")
+    parser.add_argument('mr', help="MR volume that defines the grid")
+    parser.add_argument('b0_map', help="Static field map of the same subject")
+    parser.add_argument('--gnl-field', required=True, help="Phantom GNL displacement field (NIfTI)")
+    parser.add_argument('--output', required=True, help="Operator file (.npz)")
+    parser.add_argument('--interpolation', choices=sorted(_WEIGHTS), default='linear')
+    parser.add_argument('--target-shape', type=int, nargs=3, default=(112, 128, 128),
+                        metavar=('Z', 'Y', 'X'), help="Upsampled grid shape (default: 112 128 128)")
+    args = parser.parse_args()
+    target_shape = tuple(args.target_shape)
+
+    MR_Volume = sitk.ReadImage(args.mr)
+    B0_Map = sitk.ReadImage(args.b0_map)
+
+    final_transform, B0_Map_Resampled = register_b0_map(MR_Volume, B0_Map)
+    B0_Map_Array_mm = formula(sitk.GetArrayFromImage(B0_Map_Resampled).astype(DEFAULT_DTYPE))
+
+    gnl_field_resampled = resample_phantom_field_cached(args.gnl_field, MR_Volume, target_shape)
+    coordinates = fused_coordinates(
+        B0_Map_Array_mm, gnl_field_resampled, target_grid_image(MR_Volume, target_shape)
+    )
+
+    # The operator maps volumes on the original MR grid to the corrected target grid
+    operator = build_warp_operator(coordinates, MR_Volume.GetSize()[::-1], args.interpolation)
+    save_warp_operator(args.output, operator)
+    print(f"Saved {args.interpolation} warp operator with {operator.nnz} weights -> {args.output}")
+
+if __name__ == "__main__":
+    main()
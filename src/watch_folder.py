@@ -0,0 +1,236 @@
+# watch_folder.py
+#
+# Watch-folder correction service. Polls an input directory for new MR / B0
+# map pairs exported from the console, queues them on a warm process pool and
+# writes the corrected volumes atomically to an output directory. The workers
+# are started once and keep the imports and the resampled phantom GNL field
+# (in shared memory) in memory between scans, so a scan is corrected seconds
+# after its export.
+#
+# Pairs are matched by name: <scan>_MR.nii and <scan>_B0.nii give
+# <output_dir>/<scan>_b0_gnl.nii. A file is only picked up once it has not
+# been modified for --settle seconds, so partially exported files are skipped.
+# If a worker dies (e.g. killed by the out-of-memory killer), the pool is
+# rebuilt and the scans it was running are queued again, up to --retries
+# times.
+#
+# Usage:
+#     python src/watch_folder.py incoming/ results/ --gnl-field field.nii --workers 4
+
+import argparse
+import os
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from batch_correction import _correct_row, _init_worker, share_array
+from gnl_field_cache import resample_phantom_field_cached
+from nifti_mmap import read_image_information
+from roi_mask import parse_roi
+
+def _init_service_worker(*initargs):
+    # Ctrl+C reaches the whole process group; only the service itself stops
+    # (after draining the queue), workers keep the default SIGTERM behaviour
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    _init_worker(*initargs)
+
+def find_pairs(input_dir, mr_suffix='_MR.nii', b0_suffix='_B0.nii', settle=5.0):
+    """Returns {scan: (mr_path, b0_path)} for all complete pairs not modified for settle seconds."""
+    now = time.time()
+    names = set(os.listdir(input_dir))
+    pairs = {}
+    for name in sorted(names):
+        if not name.endswith(mr_suffix):
+            continue
+        scan = name[:-len(mr_suffix)]
+        if scan + b0_suffix not in names:
+            continue
+        paths = (os.path.join(input_dir, name), os.path.join(input_dir, scan + b0_suffix))
+        try:
+            if all(now - os.stat(path).st_mtime >= settle for path in paths):
+                pairs[scan] = paths
+        except FileNotFoundError:
+            continue
+    return pairs
+
+class CorrectionService:
+    """Warm process pool that corrects MR / B0 map pairs with a shared, preloaded GNL field.
+
+    The resampled GNL field only depends on target_shape, so the pool and the
+    shared field are built once, for the first scan, and serve every later
+    scan whatever its origin or spacing. A broken pool (a worker died) is discarded and
+    rebuilt on the next submit; its scans are queued again up to retries
+    times.
+    """
+
+    def __init__(self, gnl_field_path, output_dir, target_shape=(112, 128, 128), workers=None,
+                 output_suffix='_b0_gnl.nii', roi=None, retries=1):
+        self.gnl_field_path = gnl_field_path
+        self.output_dir = output_dir
+        self.target_shape = tuple(target_shape)
+        self.workers = workers
+        self.output_suffix = output_suffix
+        self.roi = roi
+        self.retries = retries
+        self.pending = {}
+        self._jobs = {}
+        self._attempts = {}
+        self._executor = None
+        self._shm = None
+
+    def _start_pool(self, mr_path):
+        if self._executor is not None:
+            return
+
+        Phantom_Displacement_Field_Array_Resampled = resample_phantom_field_cached(
+            self.gnl_field_path, read_image_information(mr_path), self.target_shape
+        )
+        self._shm = share_array(Phantom_Displacement_Field_Array_Resampled)
+        initargs = (
+            self._shm.name,
+            Phantom_Displacement_Field_Array_Resampled.shape,
+            Phantom_Displacement_Field_Array_Resampled.dtype,
+        )
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers, initializer=_init_service_worker, initargs=initargs
+        )
+
+    def output_path(self, scan):
+        return os.path.join(self.output_dir, scan + self.output_suffix)
+
+    def submit(self, scan, mr_path, b0_path):
+        """Queues one pair; returns False if it is already queued or corrected."""
+        if scan in self.pending or os.path.exists(self.output_path(scan)):
+            return False
+        self._start_pool(mr_path)
+        row = {'mr': mr_path, 'b0': b0_path, 'output': self.output_path(scan)}
+        try:
+            future = self._executor.submit(_correct_row, row, self.target_shape, False, self.roi)
+        except BrokenProcessPool:
+            # The pool broke before its failed scans were collected
+            self.close()
+            self._start_pool(mr_path)
+            future = self._executor.submit(_correct_row, row, self.target_shape, False, self.roi)
+        self.pending[scan] = future
+        self._jobs[scan] = (self._executor, mr_path, b0_path)
+        return True
+
+    def collect(self):
+        """Returns [(scan, seconds or error)] of the scans finished since the last call.
+
+        Scans lost to a broken pool are queued again instead of being
+        returned, until they have been retried retries times.
+        """
+        finished = []
+        requeue = []
+        for scan, future in list(self.pending.items()):
+            if not future.done():
+                continue
+            del self.pending[scan]
+            executor, mr_path, b0_path = self._jobs.pop(scan)
+            error = future.exception()
+            if isinstance(error, BrokenProcessPool):
+                if executor is self._executor:
+                    self.close()
+                attempts = self._attempts.get(scan, 0)
+                if attempts < self.retries:
+                    self._attempts[scan] = attempts + 1
+                    requeue.append((scan, mr_path, b0_path))
+                    continue
+            self._attempts.pop(scan, None)
+            finished.append((scan, error if error is not None else future.result()[0]))
+        for scan, mr_path, b0_path in requeue:
+            self.submit(scan, mr_path, b0_path)
+        return finished
+
+    def wait(self):
+        """Blocks until all queued scans are finished."""
+        for future in list(self.pending.values()):
+            future.exception()
+
+    def drain(self):
+        """Blocks until all queued scans, including requeued ones, are finished; returns them as collect."""
+        finished = []
+        while self.pending:
+            self.wait()
+            finished.extend(self.collect())
+        return finished
+
+    def close(self):
+        """Shuts the pool down and releases the shared GNL field; a broken pool is discarded."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+def _stop(signum, frame):
+    raise KeyboardInterrupt
+
+def _report(finished):
+    for scan, result in finished:
+        if isinstance(result, Exception):
+            print(f"FAILED {scan}: {result}", flush=True)
+        else:
+            print(f"{scan} corrected ({result:.1f} s)", flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Watch a directory and correct new MR / B0 map pairs.")
+    parser.add_argument('input_dir', help="Directory the console exports to")
+    parser.add_argument('output_dir', help="Directory for the corrected volumes")
+    parser.add_argument('--gnl-field', required=True, help="Phantom GNL displacement field (NIfTI)")
+    parser.add_argument('--target-shape', type=int, nargs=3, default=(112, 128, 128),
+                        metavar=('Z', 'Y', 'X'), help="Upsampled grid shape (default: 112 128 128)")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument('--mr-suffix', default='_MR.nii', help="File name suffix of MR volumes")
+    parser.add_argument('--b0-suffix', default='_B0.nii', help="File name suffix of B0 maps")
+    parser.add_argument('--output-suffix', default='_b0_gnl.nii',
+                        help="File name suffix of corrected volumes (.zarr for the zarr backend)")
+    parser.add_argument('--interval', type=float, default=2.0, help="Polling interval (s)")
+    parser.add_argument('--settle', type=float, default=5.0,
+                        help="Seconds a file must be unmodified before it is picked up")
+    parser.add_argument('--roi', type=parse_roi,
+                        help="Region of interest: 'auto' (Otsu foreground) or x0,y0,z0,x1,y1,z1")
+    parser.add_argument('--retries', type=int, default=1,
+                        help="Times a scan lost to a crashed worker is queued again (default: 1)")
+    parser.add_argument('--once', action='store_true',
+                        help="Correct the pairs present now and exit instead of watching")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    service = CorrectionService(
+        args.gnl_field, args.output_dir, args.target_shape, args.workers, args.output_suffix, args.roi,
+        args.retries
+    )
+    failed = set()
+    # Stop gracefully on SIGTERM (e.g. from systemd) as on Ctrl+C
+    signal.signal(signal.SIGTERM, _stop)
+    print(f"Watching {args.input_dir} -> {args.output_dir}", flush=True)
+    try:
+        while True:
+            pairs = find_pairs(args.input_dir, args.mr_suffix, args.b0_suffix,
+                               0.0 if args.once else args.settle)
+            for scan, (mr_path, b0_path) in pairs.items():
+                if scan not in failed and service.submit(scan, mr_path, b0_path):
+                    print(f"Queued {scan}", flush=True)
+
+            finished = service.drain() if args.once else service.collect()
+            # Failed scans are not retried until the service is restarted
+            failed.update(scan for scan, result in finished if isinstance(result, Exception))
+            _report(finished)
+            if args.once:
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        print("Stopping, waiting for queued scans", flush=True)
+        _report(service.drain())
+    finally:
+        service.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from scipy.ndimage import gaussian_filter
+
+from B0_correction import (apply_b0_displacement, apply_b0_shift, apply_b0_shift_1d, b0_shift_axis,
+                           b0_shift_region, region_geometry, upsample_image)
+from parallel_warp import zoom_region
+
+DIRECTIONS = {
+    'identity': (1, 0, 0, 0, 1, 0, 0, 0, 1),
+    'flipped_z': (1, 0, 0, 0, 1, 0, 0, 0, -1),
+    'permuted': (0, 0, 1, 1, 0, 0, 0, -1, 0),
+    'oblique': (1, 0, 0, 0, 0.8, -0.6, 0, 0.6, 0.8),
+}
+
+@pytest.mark.parametrize('name', sorted(DIRECTIONS))
+def test_b0_shift_matches_displacement_field_resample(name):
+    rng = np.random.default_rng(0)
+    volume_array = gaussian_filter(rng.normal(0.0, 100.0, (20, 22, 24)), 1).astype(np.float32)
+    B0_Map_Array_mm = gaussian_filter(rng.normal(0.0, 2.0, (20, 22, 24)), 3).astype(np.float32)
+    image = sitk.GetImageFromArray(volume_array)
+    image.SetSpacing([0.2, 0.25, 0.3])
+    image.SetOrigin([1.0, -2.0, 3.0])
+    image.SetDirection(DIRECTIONS[name])
+
+    expected = sitk.GetArrayFromImage(apply_b0_displacement(image, B0_Map_Array_mm))
+    corrected = apply_b0_shift(image, volume_array, B0_Map_Array_mm, dtype=np.float64)
+    assert (b0_shift_axis(image) is None) == (name == 'oblique')
+    np.testing.assert_allclose(corrected, expected, atol=1e-3 * np.abs(expected).max())
+
+@pytest.mark.parametrize('name', sorted(DIRECTIONS))
+def test_b0_shift_region_matches_whole_volume(name):
+    rng = np.random.default_rng(1)
+    volume_array = gaussian_filter(rng.normal(0.0, 100.0, (14, 16, 18)), 1).astype(np.float32)
+    B0_Map_Array_mm = gaussian_filter(rng.normal(0.0, 0.4, (14, 16, 18)), 3).astype(np.float32)
+    image = sitk.GetImageFromArray(volume_array)
+    image.SetSpacing([0.2, 0.25, 0.3])
+    image.SetDirection(DIRECTIONS[name])
+    target_shape = (42, 48, 54)
+    mask = np.zeros(target_shape, dtype=bool)
+    mask[15:25, 20:30, 25:35] = True
+
+    # Whole-volume upsampling, shift masked afterwards
+    upsampled_array, upsampled = upsample_image(image, volume_array, target_shape)
+    B0_Upsampled_Array, _ = upsample_image(image, B0_Map_Array_mm, target_shape)
+    expected = apply_b0_shift(upsampled, upsampled_array, B0_Upsampled_Array, dtype=np.float64, mask=mask)
+
+    # Upsampling and shift of the region around the mask only
+    box = (slice(15, 25), slice(20, 30), slice(25, 35))
+    region = b0_shift_region(box, upsampled, float(np.abs(B0_Map_Array_mm).max()))
+    corrected = np.zeros(target_shape)
+    corrected[region] = apply_b0_shift(
+        region_geometry(upsampled, region), zoom_region(volume_array, target_shape, region),
+        zoom_region(B0_Map_Array_mm, target_shape, region), dtype=np.float64, mask=mask[region]
+    )
+    assert np.prod([r.stop - r.start for r in region]) < np.prod(target_shape)
+    np.testing.assert_allclose(corrected, expected, atol=1e-4 * np.abs(expected).max())
+
+def test_b0_shift_along_requested_axis():
+    rng = np.random.default_rng(2)
+    volume_array = gaussian_filter(rng.normal(0.0, 100.0, (12, 14, 16)), 1).astype(np.float32)
+    B0_Map_Array_mm = gaussian_filter(rng.normal(0.0, 2.0, (12, 14, 16)), 3).astype(np.float32)
+    image = sitk.GetImageFromArray(volume_array)
+    image.SetSpacing([0.2, 0.25, 0.3])
+
+    corrected = apply_b0_shift(image, volume_array, B0_Map_Array_mm, frequency_encoding_axis=2)
+    expected = apply_b0_shift_1d(volume_array, B0_Map_Array_mm, 0.2, axis=2)
+    np.testing.assert_array_equal(corrected, expected)
+    assert not np.allclose(corrected, apply_b0_shift(image, volume_array, B0_Map_Array_mm))
+    with pytest.raises(ValueError):
+        apply_b0_shift(image, volume_array, B0_Map_Array_mm, frequency_encoding_axis=3)
@@ -0,0 +1,9 @@
+import pytest
+
+from batch_correction import read_manifest, run_batch
+
+def test_empty_manifest_is_rejected(tmp_path):
+    manifest = tmp_path / 'manifest.csv'
+    manifest.write_text('mr,b0,output\n')
+    with pytest.raises(ValueError, match="manifest has no rows"):
+        run_batch(read_manifest(manifest), str(tmp_path / 'field.nii'))
@@ -0,0 +1,42 @@
+import numpy as np
+import SimpleITK as sitk
+
+from B0_GNL_composed_correction import target_grid_image
+from jacobian import b0_coordinates, composed_coordinates, gnl_coordinates, jacobian_statistics
+
+def _affine_field(target_shape, A):
+    """Phantom field g(p) = A p in target-grid voxels, as a (z, y, x, 3) array."""
+    grid = np.indices(target_shape, dtype=np.float64)
+    return np.einsum('ij,j...->...i', A, grid).astype(np.float32)
+
+def test_gnl_jacobian_of_affine_field():
+    MR_Volume = sitk.Image([16, 14, 12], sitk.sitkFloat32)
+    MR_Volume.SetSpacing([0.2, 0.25, 0.3])
+    target_shape = (24, 28, 32)
+    target_image = target_grid_image(MR_Volume, target_shape)
+    A = np.array([[0.02, 0.01, 0.0], [0.0, -0.03, 0.005], [0.01, 0.0, 0.04]])
+    gnl_field_resampled = _affine_field(target_shape, A)
+    B0_Map_Array_mm = np.zeros((12, 14, 16), dtype=np.float32)
+    expected = np.linalg.det(np.eye(3) + A)
+
+    for coordinates in (gnl_coordinates(B0_Map_Array_mm, gnl_field_resampled, target_image, np.float64),
+                        composed_coordinates(B0_Map_Array_mm, gnl_field_resampled, target_image, np.float64)):
+        summary = jacobian_statistics(coordinates, target_shape, slab=5).summary()
+        assert summary['count'] == np.prod(target_shape)
+        np.testing.assert_allclose([summary['min'], summary['max']], expected, rtol=1e-6)
+
+def test_b0_jacobian_of_linear_shift():
+    MR_Volume = sitk.Image([16, 14, 12], sitk.sitkFloat32)
+    MR_Volume.SetSpacing([0.2, 0.25, 0.3])
+    target_shape = (24, 28, 32)
+    target_image = target_grid_image(MR_Volume, target_shape)
+    # Shift of 0.01 mm per mm along physical z of the MR grid; target row p
+    # samples MR row p * scale (as scipy.ndimage.zoom) and the shift is applied
+    # in target voxels
+    z_mm = np.arange(12) * 0.3
+    scale = 11 / 23
+    expected = 1 + 0.01 * 0.3 * scale / target_image.GetSpacing()[2]
+    B0_Map_Array_mm = np.broadcast_to(0.01 * z_mm[:, None, None], (12, 14, 16)).astype(np.float64)
+    summary = jacobian_statistics(b0_coordinates(B0_Map_Array_mm, target_image, np.float64),
+                                  target_shape).summary()
+    np.testing.assert_allclose([summary['min'], summary['max']], expected, rtol=1e-6)
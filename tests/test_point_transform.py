@@ -0,0 +1,47 @@
+import numpy as np
+import SimpleITK as sitk
+from scipy.ndimage import gaussian_filter
+
+from B0_GNL_composed_correction import fused_coordinates, target_grid_image
+from gnl_field_cache import resample_phantom_field
+from point_transform import PointTransformer, index_to_physical
+
+def _transformer(tmp_path, target_shape=(24, 28, 32)):
+    rng = np.random.default_rng(0)
+    MR_Volume = sitk.Image([16, 14, 12], sitk.sitkFloat32)
+    MR_Volume.SetSpacing([0.2, 0.25, 0.3])
+    MR_Volume.SetOrigin([1.0, -2.0, 3.0])
+    MR_Volume.SetDirection([0, 1, 0, 1, 0, 0, 0, 0, -1])
+    B0_Map_Array_mm = gaussian_filter(rng.normal(0.0, 1.0, (12, 14, 16)), 2).astype(np.float32)
+    phantom_field = gaussian_filter(rng.normal(0.0, 3.0, (6, 7, 8, 3)), (1, 1, 1, 0)).astype(np.float32)
+    gnl_field_resampled = resample_phantom_field(phantom_field, target_shape)
+    transformer = PointTransformer(
+        B0_Map_Array_mm, gnl_field_resampled, MR_Volume, target_shape, cache_dir=str(tmp_path)
+    )
+    return transformer, B0_Map_Array_mm, gnl_field_resampled, MR_Volume
+
+def test_forward_matches_fused_coordinates(tmp_path):
+    target_shape = (24, 28, 32)
+    transformer, B0_Map_Array_mm, gnl_field_resampled, MR_Volume = _transformer(tmp_path, target_shape)
+    target_image = target_grid_image(MR_Volume, target_shape)
+    coordinates = fused_coordinates(
+        B0_Map_Array_mm, gnl_field_resampled, target_image, dtype='float64'
+    )
+    grid = np.indices(target_shape, dtype=np.float64).reshape(3, -1)
+    np.testing.assert_allclose(transformer.forward_index(grid), coordinates.reshape(3, -1), atol=1e-5)
+
+    # The same through physical points of the corrected and the acquired image
+    points = index_to_physical(grid, target_image)
+    np.testing.assert_allclose(
+        transformer.corrected_to_acquired(points),
+        index_to_physical(coordinates.reshape(3, -1), MR_Volume), atol=1e-5
+    )
+
+def test_inverse_round_trip(tmp_path):
+    transformer, _, _, MR_Volume = _transformer(tmp_path)
+    rng = np.random.default_rng(1)
+    index = rng.uniform(3, 9, (3, 200))
+    points = index_to_physical(index, MR_Volume)
+    corrected = transformer.acquired_to_corrected(points)
+    # Linear interpolation of the inverse on the MR grid: well below a voxel (0.2-0.3 mm)
+    np.testing.assert_allclose(transformer.corrected_to_acquired(corrected), points, atol=2e-2)
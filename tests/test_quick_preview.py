@@ -0,0 +1,39 @@
+import numpy as np
+import SimpleITK as sitk
+
+from B0_GNL_composed_correction import fused_coordinates, target_grid_image
+from gnl_field_cache import resample_phantom_field
+from quick_preview import displacement_summary, preview_coordinates
+
+def _subject(rng):
+    MR_Volume = sitk.Image([25, 21, 17], sitk.sitkFloat32)
+    MR_Volume.SetSpacing([0.2, 0.25, 0.3])
+    B0_Map_Array_mm = rng.normal(0.0, 0.2, (17, 21, 25)).astype(np.float32)
+    phantom_field = rng.normal(0.0, 1.5, (6, 7, 8, 3)).astype(np.float32)
+    return MR_Volume, B0_Map_Array_mm, phantom_field
+
+def test_preview_coordinates_match_subsampled_full_grid():
+    MR_Volume, B0_Map_Array_mm, phantom_field = _subject(np.random.default_rng(0))
+    target_shape = (34, 42, 50)
+    target_image = target_grid_image(MR_Volume, target_shape)
+    gnl_field_resampled = resample_phantom_field(phantom_field, target_shape)
+
+    full = fused_coordinates(B0_Map_Array_mm, gnl_field_resampled, target_image, dtype=np.float32)
+    for shrink in (2, 3):
+        preview = preview_coordinates(B0_Map_Array_mm, gnl_field_resampled, target_image, shrink, np.float32)
+        np.testing.assert_allclose(preview, full[:, ::shrink, ::shrink, ::shrink], atol=1e-5)
+
+def test_constant_gnl_shift_in_target_voxels():
+    MR_Volume, _, _ = _subject(np.random.default_rng(1))
+    target_shape = (34, 42, 50)
+    B0_Map_Array_mm = np.zeros((17, 21, 25), dtype=np.float32)
+    gnl_field_resampled = np.zeros(target_shape + (3,), dtype=np.float32)
+    gnl_field_resampled[..., 2] = 1.0
+
+    coordinates = preview_coordinates(
+        B0_Map_Array_mm, gnl_field_resampled, target_grid_image(MR_Volume, target_shape), 2, np.float32
+    )
+    summary = displacement_summary(coordinates, B0_Map_Array_mm, MR_Volume, target_shape, 2)
+    # One target voxel along x is (25 - 1) / (50 - 1) native voxels of 0.2 mm
+    np.testing.assert_allclose(summary['displacement_max_mm'], 0.2 * 24 / 49, rtol=1e-5)
+    np.testing.assert_allclose(summary['displacement_mean_mm'], 0.2 * 24 / 49, rtol=1e-5)
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from scipy.ndimage import gaussian_filter
+
+import B0_correction
+import B0_GNL_composed_correction
+from B0_correction import correct_b0
+from B0_GNL_composed_correction import correct_subject
+from gnl_field_cache import resample_phantom_field
+from Phantom_displacement_GNL import correct_gnl
+from roi_mask import box_mask, target_mask
+
+BOX = (5, 4, 3, 11, 10, 8)
+
+def _subject():
+    rng = np.random.default_rng(0)
+    MR_Volume = sitk.GetImageFromArray(
+        gaussian_filter(rng.normal(100.0, 30.0, (12, 14, 16)), 1).astype(np.float32)
+    )
+    MR_Volume.SetSpacing([0.2, 0.25, 0.3])
+    MR_Volume.SetDirection([1, 0, 0, 0, 1, 0, 0, 0, -1])
+    B0_Map = sitk.GetImageFromArray(
+        gaussian_filter(rng.normal(0.0, 40.0, (12, 14, 16)), 3).astype(np.float32)
+    )
+    B0_Map.CopyInformation(MR_Volume)
+    return MR_Volume, B0_Map
+
+@pytest.fixture
+def registrations(monkeypatch):
+    """Replaces the registration by a deterministic identity resample and records its options."""
+    calls = []
+
+    def register_b0_map(MR_Volume, B0_Map, **options):
+        calls.append(options)
+        return sitk.Transform(), sitk.Resample(B0_Map, MR_Volume, sitk.Transform(), sitk.sitkLinear)
+
+    monkeypatch.setattr(B0_correction, 'register_b0_map', register_b0_map)
+    monkeypatch.setattr(B0_GNL_composed_correction, 'register_b0_map', register_b0_map)
+    return calls
+
+def _assert_roi_matches_full(full, restricted, MR_Volume, target_shape):
+    inside = target_mask(box_mask(MR_Volume, BOX), target_shape)
+    full = sitk.GetArrayFromImage(full)
+    restricted = sitk.GetArrayFromImage(restricted)
+    np.testing.assert_allclose(restricted[inside], full[inside], rtol=0, atol=1e-4 * np.abs(full).max())
+    assert not restricted[~inside].any()
+
+def test_correct_subject_roi_matches_full_correction(registrations):
+    MR_Volume, B0_Map = _subject()
+    target_shape = (18, 21, 24)
+    rng = np.random.default_rng(1)
+    phantom_field = gaussian_filter(rng.normal(0.0, 2.0, (6, 7, 8, 3)), (1, 1, 1, 0)).astype(np.float32)
+    gnl_field_resampled = resample_phantom_field(phantom_field, target_shape)
+
+    full = correct_subject(MR_Volume, B0_Map, gnl_field_resampled, target_shape)
+    restricted = correct_subject(MR_Volume, B0_Map, gnl_field_resampled, target_shape, roi=BOX)
+    _assert_roi_matches_full(full, restricted, MR_Volume, target_shape)
+    # The region of interest never reaches the registration metric
+    assert all(options.get('mask') is None for options in registrations)
+
+def test_correct_b0_roi_matches_full_correction(registrations):
+    MR_Volume, B0_Map = _subject()
+    target_shape = (18, 21, 24)
+    full = correct_b0(MR_Volume, B0_Map, target_shape=target_shape)
+    restricted = correct_b0(MR_Volume, B0_Map, target_shape=target_shape, roi=BOX)
+    _assert_roi_matches_full(full, restricted, MR_Volume, target_shape)
+    assert all(options.get('mask') is None for options in registrations)
+
+def test_chained_roi_covers_the_same_region(registrations):
+    MR_Volume, B0_Map = _subject()
+    target_shape = (18, 21, 24)
+    rng = np.random.default_rng(2)
+    phantom_field = gaussian_filter(rng.normal(0.0, 1.0, (6, 7, 8, 3)), (1, 1, 1, 0)).astype(np.float32)
+    b0_corrected = correct_b0(MR_Volume, B0_Map, target_shape=target_shape, roi=BOX)
+    corrected = correct_gnl(b0_corrected, phantom_field, roi=BOX, roi_image=MR_Volume)
+    inside = target_mask(box_mask(MR_Volume, BOX), target_shape)
+    assert sitk.GetArrayViewFromImage(b0_corrected)[inside].all()
+    assert sitk.GetArrayViewFromImage(corrected)[inside].all()
+    assert not sitk.GetArrayViewFromImage(corrected)[~inside].any()
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from scipy.ndimage import gaussian_filter
+
+import session_correction
+from array_store import read_image, read_volume
+from B0_correction import formula
+from gnl_field_cache import resample_phantom_field, resample_phantom_field_cached
+from session_correction import correct_session
+
+pytest.importorskip('zarr')
+
+def test_session_stores_b0_shift_and_gnl_field(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    MR_Volume = sitk.GetImageFromArray(
+        gaussian_filter(rng.normal(100.0, 30.0, (8, 10, 12)), 1).astype(np.float32)
+    )
+    MR_Volume.SetSpacing([0.2, 0.25, 0.3])
+    MR_Volume.SetOrigin([1.0, 2.0, 3.0])
+    B0_Map = sitk.GetImageFromArray(gaussian_filter(rng.normal(0.0, 40.0, (8, 10, 12)), 2).astype(np.float32))
+    B0_Map.CopyInformation(MR_Volume)
+    phantom_field = sitk.GetImageFromArray(rng.normal(0.0, 1.0, (4, 5, 6, 3)), isVector=True)
+    sitk.WriteImage(MR_Volume, str(tmp_path / 'mr.nii'))
+    sitk.WriteImage(B0_Map, str(tmp_path / 'b0.nii'))
+    sitk.WriteImage(phantom_field, str(tmp_path / 'field.nii'))
+
+    monkeypatch.setattr(session_correction, 'register_b0_map', lambda MR_Volume, B0_Map: (
+        sitk.Transform(), sitk.Resample(B0_Map, MR_Volume, sitk.Transform(), sitk.sitkLinear)
+    ))
+    monkeypatch.setattr(session_correction, 'resample_phantom_field_cached',
+                        lambda *args: resample_phantom_field_cached(*args, cache_dir=str(tmp_path / 'cache')))
+    target_shape = (12, 15, 18)
+    session = {
+        'b0_map': str(tmp_path / 'b0.nii'),
+        'gnl_field': str(tmp_path / 'field.nii'),
+        'target_shape': list(target_shape),
+        'sequences': [
+            {'mr': str(tmp_path / 'mr.nii'), 'output': str(tmp_path / 'out' / 'FLASH.nii')},
+            {'mr': str(tmp_path / 'mr.nii'), 'output': str(tmp_path / 'out' / 'RARE.nii'),
+             'G_read_percentFLASH': 0.0412},
+        ],
+    }
+    store_fields = tmp_path / 'fields'
+    list(correct_session(session, store_fields=str(store_fields)))
+
+    b0_shift = read_image(store_fields / 'RARE_b0_shift_mm.zarr')
+    expected = formula(sitk.GetArrayFromImage(B0_Map), G_read_percentFLASH=0.0412)
+    np.testing.assert_allclose(sitk.GetArrayFromImage(b0_shift), expected, rtol=1e-6)
+    assert b0_shift.GetOrigin() == MR_Volume.GetOrigin()
+
+    # Both sequences share a grid, so the GNL field is stored once
+    assert (store_fields / 'FLASH_gnl_field.zarr').is_dir()
+    assert not (store_fields / 'RARE_gnl_field.zarr').exists()
+    np.testing.assert_allclose(
+        read_volume(store_fields / 'FLASH_gnl_field.zarr'),
+        resample_phantom_field(sitk.GetArrayFromImage(phantom_field), target_shape), rtol=1e-6
+    )
@@ -3,9 +3,9 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 def load_nifti(file_path):
-    """Load a NIfTI file and return the image data."""
+    """Load a NIfTI label map in its stored (integer) dtype."""
     img = nib.load(file_path)
-    return img.get_fdata()
+    return np.asanyarray(img.dataobj)
 
 def dice_coefficient(seg1, seg2):
     """Compute the Dice coefficient between two binary phantom_segmentations."""
@@ -7,14 +7,14 @@ import matplotlib.pyplot as plt
 # mouse jacobian
 # jacobian_img_1 = nib.load('b0_correction_analysis/data/phantom_jacobian/jacobian_determinant_b0.nii')
 jacobian_img_1 = nib.load('b0_correction_analysis/data/mouse_data/mouse_phantom_b0_jacobian.nii')
-jacobian_data_1 = jacobian_img_1.get_fdata()
+jacobian_data_1 = jacobian_img_1.get_fdata(dtype=np.float32)
 
 # Load the second Jacobian determinant map
 
 #mouse jacobian
 # jacobian_img_2 = nib.load('b0_correction_analysis/data/phantom_jacobian/jacobian_determinant_no_b0.nii')
 jacobian_img_2 = nib.load('b0_correction_analysis/data/mouse_data/mouse_only_b0_jacobian.nii')
-jacobian_data_2 = jacobian_img_2.get_fdata()
+jacobian_data_2 = jacobian_img_2.get_fdata(dtype=np.float32)
 
 
 # Compute the difference between the two Jacobian determinant maps
@@ -1,10 +1,12 @@
-import nibabel as nib
+import os
+import sys
+
 import matplotlib.pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap
 import numpy as np
-import pandas as pd
-import openpyxl
-from openpyxl.styles import Font, Alignment, PatternFill
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from displacement_statistics import field_statistics, statistics_row, write_summary
 
 # Define the colors for the colormap
 colors = ["blue", "aquamarine", "yellow", "red"]
@@ -19,40 +21,27 @@ ge_deformation_field_shim2_path = 'data/deformable/displacement_fields_shim1_shi
 ge_deformation_field_shim1_b0_corrected_path = 'b0_no_b0_displacement_fields/Displacement_field_Phantom_MR_Shim1_B0_Deformable_B0_Corrected.nii'
 ge_deformation_field_shim2_b0_corrected_path = 'b0_no_b0_displacement_fields/Displacement_field_Phantom_MR_Shim2_Deformable_B0_Corrected.nii'
 
-# Load the NIfTI file
-ge_deformation_field_nii_shim1 = nib.load(ge_deformation_field_shim1_path)
-ge_deformation_field_nii_shim2 = nib.load(ge_deformation_field_shim2_path)
-
-ge_deformation_field_shim1_b0_corrected = nib.load(ge_deformation_field_shim1_b0_corrected_path)
-ge_deformation_field_shim2_b0_corrected = nib.load(ge_deformation_field_shim2_b0_corrected_path)
-
-# Extract the data
-ge_deformation_field_data_shim1 = ge_deformation_field_nii_shim1.get_fdata()
-ge_deformation_field_data_shim2 = ge_deformation_field_nii_shim2.get_fdata()
-
-ge_deformation_field_shim1_b0_corrected_data = ge_deformation_field_shim1_b0_corrected.get_fdata()
-ge_deformation_field_shim2_b0_corrected_data = ge_deformation_field_shim2_b0_corrected.get_fdata()
+# Displacement magnitudes are streamed once per field, chunk by chunk; the
+# magnitude histogram is kept for the summary table and the coronal
+# projection (mean across the Y-axis) for the plot
+fields = [
+    ('ge_shim1', ge_deformation_field_shim1_path),
+    ('ge_shim2', ge_deformation_field_shim2_path),
+    ('ge_shim1_b0_corrected', ge_deformation_field_shim1_b0_corrected_path),
+    ('ge_shim2_b0_corrected', ge_deformation_field_shim2_b0_corrected_path),
+]
+statistics = {name: field_statistics(path) for name, path in fields}
 
-# Remove the singleton dimension if necessary
-ge_deformation_field_data_squeezed_shim1 = np.squeeze(ge_deformation_field_data_shim1)
-ge_deformation_field_data_squeezed_shim2 = np.squeeze(ge_deformation_field_data_shim2)
+# Coronal projections, rotated and transposed
+def coronal_projection(name):
+    histogram, projection = statistics[name]
+    return np.rot90(projection, 2).T
 
-ge_deformation_field_shim1_b0_corrected_data_squeezed = np.squeeze(ge_deformation_field_shim1_b0_corrected_data)
-ge_deformation_field_shim2_b0_corrected_data_squeezed = np.squeeze(ge_deformation_field_shim2_b0_corrected_data)
+ge_coronal_projection_shim1 = coronal_projection('ge_shim1')
+ge_coronal_projection_shim2 = coronal_projection('ge_shim2')
 
-# Calculate the magnitude of the displacement vectors
-ge_magnitudes_shim1 = np.linalg.norm(ge_deformation_field_data_squeezed_shim1, axis=-1)
-ge_magnitudes_shim2 = np.linalg.norm(ge_deformation_field_data_squeezed_shim2, axis=-1)
-
-ge_magnitudes_shim1_b0_corrected = np.linalg.norm(ge_deformation_field_shim1_b0_corrected_data_squeezed, axis=-1)
-ge_magnitudes_shim2_b0_corrected = np.linalg.norm(ge_deformation_field_shim2_b0_corrected_data_squeezed, axis=-1)
-
-# Coronal projection (mean across Y-axis) and transpose
-ge_coronal_projection_shim1 = np.rot90(np.mean(ge_magnitudes_shim1, axis=1), 2).T
-ge_coronal_projection_shim2 = np.rot90(np.mean(ge_magnitudes_shim2, axis=1), 2).T
-
-ge_coronal_projection_shim1_b0_corrected = np.rot90(np.mean(ge_magnitudes_shim1_b0_corrected, axis=1), 2).T
-ge_coronal_projection_shim2_b0_corrected = np.rot90(np.mean(ge_magnitudes_shim2_b0_corrected, axis=1), 2).T
+ge_coronal_projection_shim1_b0_corrected = coronal_projection('ge_shim1_b0_corrected')
+ge_coronal_projection_shim2_b0_corrected = coronal_projection('ge_shim2_b0_corrected')
 
 fig, axes = plt.subplots(1, 4, figsize=(16, 11), constrained_layout=True)
 
@@ -94,58 +83,9 @@ cbar2.set_label('Displacement Magnitude (B0 Corrected)', fontsize=12)
 plt.show()
 
 
-# Function to calculate statistics
-def calculate_statistics(array):
-    return {
-        'Min': np.min(array),
-        'Max': np.max(array),
-        'Mean': np.mean(array),
-        'Median': np.median(array),
-        'Std Dev': np.std(array),
-        'Variance': np.var(array)
-    }
-
-
-# Creating a summary table
-summary_data = {
-    'ge_coronal_projection_shim1': calculate_statistics(ge_coronal_projection_shim1),
-    'ge_coronal_projection_shim2': calculate_statistics(ge_coronal_projection_shim2),
-    'ge_coronal_projection_shim1_b0_corrected': calculate_statistics(ge_coronal_projection_shim1_b0_corrected),
-    'ge_coronal_projection_shim2_b0_corrected': calculate_statistics(ge_coronal_projection_shim2_b0_corrected)
-}
-
-# Convert to DataFrame for better readability
-summary_df = pd.DataFrame(summary_data).T
-
-# Write the summary DataFrame to an Excel file
-excel_file_path = 'b0_no_b0_displacement_fields/displacement_field_summary.xlsx'
-summary_df.to_excel(excel_file_path, index=True, sheet_name="Summary")
-
-# Load the workbook and apply formatting
-workbook = openpyxl.load_workbook(excel_file_path)
-sheet = workbook['Summary']
-
-# Styling: Set bold font for header and index, center alignment, and light blue fill for header
-header_fill = PatternFill(start_color="DDEBF7", end_color="DDEBF7", fill_type="solid")
-header_font = Font(bold=True)
-center_alignment = Alignment(horizontal="center", vertical="center")
-
-# Apply formatting to header row and index column
-for cell in sheet["1:1"]:
-    cell.fill = header_fill
-    cell.font = header_font
-    cell.alignment = center_alignment
-
-for cell in sheet["A"]:
-    cell.font = header_font
-
-# Set column widths for better readability
-for column_cells in sheet.columns:
-    max_length = max(len(str(cell.value)) for cell in column_cells)
-    column_letter = column_cells[0].column_letter
-    sheet.column_dimensions[column_letter].width = max_length + 2
-
-# Save the formatted workbook
-workbook.save(excel_file_path)
-
-print(f"Excel file saved as {excel_file_path}")
+# Summary table of the magnitude and coronal projection statistics of all
+# fields, from the same single pass per field, written as one CSV table
+summary_file_path = 'b0_no_b0_displacement_fields/displacement_field_summary.csv'
+write_summary([statistics_row(name, *statistics[name]) for name, path in fields], summary_file_path)
+
+print(f"Summary table saved as {summary_file_path}")